@@ -32,7 +32,7 @@ setup(name='syntrax',
     platforms = ['Any'],
     install_requires = [],
     packages = [],
-    py_modules = ['syntrax', 'ez_setup'],
+    py_modules = ['syntrax', 'syntrax_sphinx', 'ez_setup'],
     entry_points = {
         'console_scripts': ['syntrax = syntrax:main']
     },
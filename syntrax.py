@@ -12,66 +12,108 @@ import io
 import copy
 import subprocess
 import collections
+import gzip
+import struct
+import json
+import hashlib
+import threading
+import Queue
+import time
 
-import cairo
 import math
 
-try:
-  import pango
-  import pangocairo
-  use_pygobject = False
-except ImportError:
-  import gi
-  gi.require_version('PangoCairo', '1.0')
-  gi.require_version('Pango', '1.0')
-  from gi.repository import Pango as pango
-  from gi.repository import PangoCairo as pangocairo
-  use_pygobject = True
-
-try:
-  import webcolors
-  have_webcolors = True
-except ImportError:
-  have_webcolors = False
+
+def _load_cairo():
+  import cairo
+  return cairo
+
+def _load_pango():
+  # Returns the Pango and PangoCairo modules and a flag for the PyGObject API
+  try:
+    import pango
+    import pangocairo
+    return (pango, pangocairo, False)
+  except ImportError:
+    import gi
+    gi.require_version('PangoCairo', '1.0')
+    gi.require_version('Pango', '1.0')
+    from gi.repository import Pango as pango
+    from gi.repository import PangoCairo as pangocairo
+    return (pango, pangocairo, True)
+
+def _load_webcolors():
+  try:
+    import webcolors
+    return webcolors
+  except ImportError:
+    return None
+
+# Rendering libraries are imported on first use so that commands and SVG
+# output with builtin metrics never load the GTK stack
+backend_loaders = {
+  'cairo': _load_cairo,
+  'pango': _load_pango,
+  'webcolors': _load_webcolors
+}
+
+_loaded_backends = {}
+_backend_lock = threading.Lock()
+
+# Pango layouts share a font map that isn't safe to use from several threads.
+# All text measurement and drawing with Pango is serialized through this lock.
+pango_lock = threading.RLock()
+
+def load_backend(name):
+  '''Get the module(s) for a backend, importing them on first use'''
+  if name not in _loaded_backends:
+    with _backend_lock:
+      if name not in _loaded_backends:
+        _loaded_backends[name] = backend_loaders[name]()
+  return _loaded_backends[name]
 
 
 __version__ = '1.1'
 
 def cairo_font(tk_font):
+  pango = load_backend('pango')[0]
   family, size, weight = tk_font
   return pango.FontDescription('{} {} {}'.format(family, weight, size))
 
 def cairo_text_bbox(text, font_params, scale=1.0):
-  surf = cairo.ImageSurface(cairo.FORMAT_ARGB32, 8, 8)
-  ctx = cairo.Context(surf)
+  cairo = load_backend('cairo')
+  _, pangocairo, use_pygobject = load_backend('pango')
 
-  # The scaling must match the final context.
-  # If not there can be a mismatch between the computed extents here
-  # and those generated for the final render.
-  ctx.scale(scale, scale)
+  with pango_lock:
+    surf = cairo.ImageSurface(cairo.FORMAT_ARGB32, 8, 8)
+    ctx = cairo.Context(surf)
+
+    # The scaling must match the final context.
+    # If not there can be a mismatch between the computed extents here
+    # and those generated for the final render.
+    ctx.scale(scale, scale)
 
-  font = cairo_font(font_params)
-
-  if use_pygobject:
-    layout = pangocairo.create_layout(ctx)
-    pctx = layout.get_context()
-    fo = cairo.FontOptions()
-    fo.set_antialias(cairo.ANTIALIAS_SUBPIXEL)
-    pangocairo.context_set_font_options(pctx, fo)
-    layout.set_font_description(font)
-    layout.set_text(text, len(text))
-    re = layout.get_pixel_extents()[1]
-    extents = (re.x, re.y, re.x + re.width, re.y + re.height)
-
-  else: # pyGtk
-    pctx = pangocairo.CairoContext(ctx)
-    pctx.set_antialias(cairo.ANTIALIAS_SUBPIXEL)
-    layout = pctx.create_layout()
-    layout.set_font_description(font)
-    layout.set_text(text)
-
-    #print('@@ EXTENTS:', layout.get_pixel_extents()[1])
-    extents = layout.get_pixel_extents()[1]
+    font = cairo_font(font_params)
+
+    if use_pygobject:
+      layout = pangocairo.create_layout(ctx)
+      pctx = layout.get_context()
+      fo = cairo.FontOptions()
+      fo.set_antialias(cairo.ANTIALIAS_SUBPIXEL)
+      pangocairo.context_set_font_options(pctx, fo)
+      layout.set_font_description(font)
+      layout.set_text(text, len(text))
+      re = layout.get_pixel_extents()[1]
+      extents = (re.x, re.y, re.x + re.width, re.y + re.height)
+
+    else: # pyGtk
+      pctx = pangocairo.CairoContext(ctx)
+      pctx.set_antialias(cairo.ANTIALIAS_SUBPIXEL)
+      layout = pctx.create_layout()
+      layout.set_font_description(font)
+      layout.set_text(text)
+
+      #print('@@ EXTENTS:', layout.get_pixel_extents()[1])
+      extents = layout.get_pixel_extents()[1]
   w = extents[2] - extents[0]
   h = extents[3] - extents[1]
   x0 = - w // 2.0
@@ -80,6 +122,248 @@ def cairo_text_bbox(text, font_params, scale=1.0):
 
 
 
+class FontMetrics(object):
+  '''Advance widths and vertical metrics for a single font face
+
+  All dimensions are in font units.
+  '''
+  def __init__(self, units_per_em, ascent, descent, widths, default_width, family=None, style=None):
+    self.units_per_em = units_per_em
+    self.ascent = ascent
+    self.descent = descent # Negative below the baseline
+    self.widths = widths # Code point -> advance width
+    self.default_width = default_width
+    self.family = family
+    self.style = style
+
+  def text_size(self, text, pt_size):
+    '''Compute the pixel width and height of a line of text'''
+    px = pt_size * 96.0 / 72.0 / self.units_per_em # Pango renders at 96 DPI
+    advance = sum(self.widths.get(ord(ch), self.default_width) for ch in text)
+    w = int(round(advance * px))
+    h = int(round((self.ascent - self.descent) * px))
+    return (w, h)
+
+
+def _font_cmap(data, offset):
+  '''Decode the character to glyph mapping from a font cmap table'''
+  num_tables = struct.unpack('>H', data[offset+2:offset+4])[0]
+
+  subtables = {}
+  for i in xrange(num_tables):
+    platform, encoding, sub_offset = struct.unpack('>HHL', data[offset+4+8*i:offset+12+8*i])
+    sub = offset + sub_offset
+    fmt = struct.unpack('>H', data[sub:sub+2])[0]
+    subtables[(platform, encoding, fmt)] = sub
+
+  cmap = {}
+  # Prefer the full Unicode table
+  for key in ((3,10,12), (0,4,12), (0,6,12)):
+    if key in subtables:
+      sub = subtables[key]
+      groups = struct.unpack('>L', data[sub+12:sub+16])[0]
+      for i in xrange(groups):
+        start, end, glyph = struct.unpack('>LLL', data[sub+16+12*i:sub+28+12*i])
+        for c in xrange(start, end+1):
+          cmap[c] = glyph + c - start
+      return cmap
+
+  # Fall back to a BMP table
+  for key in ((3,1,4), (0,3,4), (0,4,4), (0,1,4), (0,0,4)):
+    if key in subtables:
+      sub = subtables[key]
+      seg_count = struct.unpack('>H', data[sub+6:sub+8])[0] // 2
+      ends = sub + 14
+      starts = ends + 2*seg_count + 2
+      deltas = starts + 2*seg_count
+      range_offsets = deltas + 2*seg_count
+      for i in xrange(seg_count):
+        end = struct.unpack('>H', data[ends+2*i:ends+2*i+2])[0]
+        start = struct.unpack('>H', data[starts+2*i:starts+2*i+2])[0]
+        delta = struct.unpack('>h', data[deltas+2*i:deltas+2*i+2])[0]
+        ro_addr = range_offsets + 2*i
+        range_offset = struct.unpack('>H', data[ro_addr:ro_addr+2])[0]
+        for c in xrange(start, end+1):
+          if c == 0xFFFF:
+            continue
+          if range_offset == 0:
+            glyph = (c + delta) & 0xFFFF
+          else:
+            addr = ro_addr + range_offset + 2*(c - start)
+            glyph = struct.unpack('>H', data[addr:addr+2])[0]
+            if glyph != 0:
+              glyph = (glyph + delta) & 0xFFFF
+          if glyph != 0:
+            cmap[c] = glyph
+      return cmap
+
+  return cmap
+
+def _font_names(data, offset):
+  '''Get the family and style names from a font name table'''
+  count, str_offset = struct.unpack('>HH', data[offset+2:offset+6])
+  names = {}
+  for i in xrange(count):
+    rec = offset + 6 + 12*i
+    platform, encoding, lang, name_id, length, noff = struct.unpack('>HHHHHH', data[rec:rec+12])
+    if name_id not in (1, 2, 16, 17):
+      continue
+    raw = data[offset+str_offset+noff:offset+str_offset+noff+length]
+    if platform == 3 or platform == 0:
+      txt = raw.decode('utf-16-be', 'replace')
+    else:
+      txt = raw.decode('latin-1')
+
+    # Prefer English Windows names
+    if name_id not in names or (platform == 3 and lang == 0x409):
+      names[name_id] = txt
+
+  # Typographic names take precedence over the legacy names
+  family = names.get(16, names.get(1, None))
+  style = names.get(17, names.get(2, None))
+  return family, style
+
+def read_font_metrics(fname):
+  '''Read metrics from a TrueType or OpenType font file
+
+  Returns a FontMetrics object.
+  '''
+  with open(fname, 'rb') as fh:
+    data = fh.read()
+
+  num_tables = struct.unpack('>H', data[4:6])[0]
+  tables = {}
+  for i in xrange(num_tables):
+    tag, _, offset, _ = struct.unpack('>4sLLL', data[12+16*i:28+16*i])
+    tables[tag.decode('latin-1')] = offset
+
+  for t in ('head', 'hhea', 'hmtx', 'cmap'):
+    if t not in tables:
+      raise ValueError('Font file "{}" is missing the {} table'.format(fname, t))
+
+  head = tables['head']
+  units_per_em = struct.unpack('>H', data[head+18:head+20])[0]
+
+  hhea = tables['hhea']
+  ascent, descent = struct.unpack('>hh', data[hhea+4:hhea+8])
+  num_metrics = struct.unpack('>H', data[hhea+34:hhea+36])[0]
+
+  hmtx = tables['hmtx']
+  advances = struct.unpack('>' + 'Hh' * num_metrics, data[hmtx:hmtx+4*num_metrics])[::2]
+
+  cmap = _font_cmap(data, tables['cmap'])
+  # Glyphs past the end of the metrics share the last advance width
+  widths = dict((c, advances[min(g, num_metrics-1)]) for c, g in cmap.iteritems())
+
+  family, style = _font_names(data, tables['name']) if 'name' in tables else (None, None)
+
+  return FontMetrics(units_per_em, ascent, descent, widths, advances[0], family, style)
+
+
+# Advance widths for ASCII 32-126 from the DejaVu faces that commonly back the
+# generic Sans and Serif families. Italic faces share the widths of the upright
+# faces. All values are in units of 1/2048 em.
+_builtin_metrics = {
+  ('sans', 'normal'): (1901, -483, (
+    651,821,942,1716,1303,1946,1597,563,799,799,1024,1716,651,739,651,690,1303,1303,1303,
+    1303,1303,1303,1303,1303,1303,1303,690,690,1716,1716,1716,1087,2048,1401,1405,1430,1577,1294,
+    1178,1587,1540,604,604,1343,1141,1767,1532,1612,1235,1612,1423,1300,1251,1499,1401,2025,1403,
+    1251,1403,799,690,799,1716,1024,1024,1255,1300,1126,1300,1260,721,1300,1298,569,569,1186,
+    569,1995,1298,1253,1300,1300,842,1067,803,1298,1212,1675,1212,1212,1075,1303,690,1303,1716,
+  )),
+  ('sans', 'bold'): (1901, -483, (
+    713,934,1067,1716,1425,2052,1786,627,936,936,1071,1716,778,850,778,748,1425,1425,1425,
+    1425,1425,1425,1425,1425,1425,1425,819,819,1716,1716,1716,1188,2048,1585,1561,1503,1700,1399,
+    1399,1681,1714,762,762,1587,1305,2038,1714,1741,1501,1741,1577,1475,1397,1663,1585,2259,1579,
+    1483,1485,936,748,936,1716,1024,1024,1382,1466,1214,1466,1389,891,1466,1458,702,702,1362,
+    702,2134,1458,1407,1466,1466,1010,1219,979,1458,1335,1892,1321,1335,1192,1458,748,1458,1716,
+  )),
+  ('serif', 'normal'): (1901, -483, (
+    651,823,942,1716,1303,1946,1823,563,799,799,1024,1716,651,692,651,690,1303,1303,1303,
+    1303,1303,1303,1303,1303,1303,1303,690,690,1716,1716,1716,1098,2048,1479,1505,1567,1642,1495,
+    1421,1636,1786,809,821,1530,1360,2097,1792,1679,1378,1679,1542,1403,1366,1726,1479,2105,1458,
+    1352,1423,799,690,799,1716,1024,1024,1221,1311,1147,1311,1212,758,1311,1319,655,635,1241,
+    655,1942,1319,1233,1311,1311,979,1051,823,1319,1157,1753,1155,1157,1079,1303,690,1303,1716,
+  )),
+  ('serif', 'bold'): (1923, -483, (
+    713,899,1067,1716,1425,1946,1849,627,969,969,1071,1716,713,850,713,748,1425,1425,1425,
+    1425,1425,1425,1425,1425,1425,1425,756,756,1716,1716,1716,1200,2048,1589,1731,1630,1776,1561,
+    1454,1749,1935,958,969,1780,1440,2267,1872,1784,1540,1784,1702,1479,1524,1786,1589,2300,1589,
+    1462,1495,969,748,969,1716,1024,1024,1327,1432,1247,1432,1303,881,1432,1489,778,741,1419,
+    778,2167,1489,1366,1432,1432,1079,1153,946,1489,1190,1763,1221,1190,1163,1317,745,1317,1716,
+  )),
+}
+
+def font_style_key(style):
+  '''Reduce a font weight or style name to normal, bold, italic, or bold italic'''
+  style = style.lower()
+  bold = 'bold' in style or 'black' in style or 'heavy' in style
+  italic = 'italic' in style or 'oblique' in style
+
+  if bold and italic:
+    return 'bold italic'
+  elif bold:
+    return 'bold'
+  elif italic:
+    return 'italic'
+  return 'normal'
+
+def builtin_font_metrics(family, weight):
+  '''Get approximate metrics for a font without reading any files'''
+  family = family.lower()
+  if 'mono' in family or 'courier' in family:
+    return FontMetrics(2048, 1901, -483, {}, 1233)
+
+  serif = ('serif' in family and 'sans' not in family) or \
+    any(f in family for f in ('times', 'roman', 'georgia'))
+  bold = font_style_key(weight) in ('bold', 'bold italic')
+
+  ascent, descent, widths = _builtin_metrics[('serif' if serif else 'sans', 'bold' if bold else 'normal')]
+  widths = dict(zip(xrange(32, 127), widths))
+  # Use a mid-width glyph for anything outside of ASCII
+  return FontMetrics(2048, ascent, descent, widths, widths[ord('n')])
+
+
+class MetricsTextBBox(object):
+  '''Measure text from font metrics rather than with Pango
+
+  TrueType and OpenType files in font_dirs are matched to diagram fonts by
+  their family and style names. Fonts that aren't found use the builtin
+  metrics. Instances are called in the same way as cairo_text_bbox().
+  '''
+  def __init__(self, font_dirs=None):
+    self.faces = {}
+
+    if font_dirs is None:
+      font_dirs = []
+
+    for d in font_dirs:
+      for fname in sorted(os.listdir(d)):
+        if os.path.splitext(fname)[1].lower() not in ('.ttf', '.otf'):
+          continue
+        try:
+          m = read_font_metrics(os.path.join(d, fname))
+        except (ValueError, IOError, struct.error):
+          print('Unable to read font metrics from "{}"'.format(fname))
+          continue
+
+        if m.family is not None: # A missing style name is taken as Regular
+          self.faces.setdefault((m.family.lower(), font_style_key(m.style or 'Regular')), m)
+
+  def face(self, family, weight):
+    key = (family.lower(), font_style_key(weight))
+    if key not in self.faces:
+      self.faces[key] = builtin_font_metrics(family, weight)
+    return self.faces[key]
+
+  def __call__(self, text, font_params, scale=1.0):
+    family, size, weight = font_params
+    w, h = self.face(family, weight).text_size(text, size)
+    x0 = - w // 2.0
+    y0 = - h // 2.0
+    return [x0,y0, x0+w,y0+h]
+
+
 class NodeStyle(object):
   def __init__(self, name, node_style=None):
     self.name = name
@@ -134,6 +418,7 @@ class DrawStyle(object):
     self.shadow = True
     self.shadow_fill = (0,0,0, 127)
     self.title_font = ('Sans', 22, 'bold')
+    self.max_width = None
 
     # Load any styles
     if styles is None:
@@ -177,7 +462,8 @@ class DrawStyle(object):
       'text_color',
       'shadow',
       'shadow_fill',
-      'title_font')
+      'title_font',
+      'max_width')
 
     ini_keys = ['{} = {}'.format(k, repr(getattr(self, k))) for k in keys]
 
@@ -194,11 +480,10 @@ def convert_color(c):
     pass
 
   # Check for named color
-  if have_webcolors:
-    try:
+  if isinstance(rgb, basestring):
+    webcolors = load_backend('webcolors')
+    if webcolors is not None:
       rgb = webcolors.name_to_rgb(rgb)
-    except AttributeError:
-      pass
 
   # Restrict to valid range
   rgb = tuple(0 if c < 0 else 255 if c > 255 else c for c in rgb)
@@ -314,6 +599,14 @@ class BaseShape(object):
     if tag is not None:
       self.tags.add(tag)
 
+  def clone(self):
+    '''Copy a shape so it can be moved and retagged independently'''
+    shape = copy.copy(self)
+    shape.options = dict(self.options)
+    shape._bbox = list(self._bbox)
+    shape.tags = set(self.tags)
+    return shape
+
   def draw(self, c):
     pass
 
@@ -395,7 +688,6 @@ class ArcShape(BaseShape):
 
 
 class TextShape(BaseShape):
-  text_id = 1
   def __init__(self, x0, y0, text_bbox, options):
     BaseShape.__init__(self)
     self.options = options
@@ -439,62 +731,344 @@ class HexBubbleShape(BaseShape):
     self._bbox = [x0, y0, x1, y1]
     self.update_tags()
 
+class PathShape(BaseShape):
+  '''A chain of connected line and arc segments drawn as a single path
 
-def cairo_draw_arrow(head, tail, fill, c):
-  width = c.get_line_width()
-  c.save()
-  dy = head[1] - tail[1]
-  dx = head[0] - tail[0]
-  angle = math.atan2(dy,dx)
-  c.translate(head[0],head[1])
-  c.rotate(angle)
-  c.scale(width, width)
-
-  # Now positioned to draw arrow at 0,0 with point facing right
+  Segments are lists of ['line', x0, y0, x1, y1] or ['arc', xc, yc, rad, start, extent]
+  with Tk angle conventions. Each segment begins where the previous one ends.
+  '''
+  def __init__(self, segments, bbox, options):
+    BaseShape.__init__(self)
+    self.options = options
+    self.segments = segments
+    self._bbox = list(bbox)
+    self.update_tags()
+
+  @property
+  def bbox(self):
+    return tuple(self._bbox)
+
+  def clone(self):
+    shape = BaseShape.clone(self)
+    shape.segments = [list(seg) for seg in self.segments]
+    return shape
+
+  def move(self, dx, dy):
+    BaseShape.move(self, dx, dy)
+    for seg in self.segments:
+      if seg[0] == 'line':
+        seg[1] += dx
+        seg[2] += dy
+        seg[3] += dx
+        seg[4] += dy
+      else: # Arc
+        seg[1] += dx
+        seg[2] += dy
+
+
+def is_connector(shape):
+  '''Identify unfilled lines, arcs, and paths that are only stroked with the line color'''
+  return isinstance(shape, (LineShape, ArcShape, PathShape)) and 'fill' not in shape.options
+
+def connector_segment(shape):
+  '''Convert a line or arc shape into a path segment'''
+  x0, y0, x1, y1 = shape.points
+  if isinstance(shape, LineShape):
+    return ['line', x0, y0, x1, y1]
+  else: # Arc
+    return ['arc', (x0 + x1) / 2, (y0 + y1) / 2, (x1 - x0) / 2, shape.options['start'],
+      shape.options['extent']]
+
+def segment_ends(seg):
+  '''Get the start and end points of a path segment'''
+  if seg[0] == 'line':
+    return (seg[1], seg[2]), (seg[3], seg[4])
+
+  _, xc, yc, rad, start, extent = seg
+  sa = math.radians(start)
+  ea = math.radians(start + extent)
+  return (xc + rad * math.cos(sa), yc - rad * math.sin(sa)), \
+    (xc + rad * math.cos(ea), yc - rad * math.sin(ea))
+
+def reverse_segment(seg):
+  if seg[0] == 'line':
+    return ['line', seg[3], seg[4], seg[1], seg[2]]
+  else: # Arc
+    _, xc, yc, rad, start, extent = seg
+    return ['arc', xc, yc, rad, start + extent, -extent]
+
+def shorten_line(seg, at_start, length):
+  '''Pull back one end of a line segment'''
+  x0, y0, x1, y1 = seg[1:]
+  seg_len = math.sqrt((x1 - x0)**2 + (y1 - y0)**2)
+  if seg_len <= length:
+    return
+
+  dx = (x1 - x0) * length / seg_len
+  dy = (y1 - y0) * length / seg_len
+  if at_start:
+    seg[1] += dx
+    seg[2] += dy
+  else:
+    seg[3] -= dx
+    seg[4] -= dy
+
+def join_collinear(segments):
+  '''Combine adjacent line segments that continue in the same direction'''
+  joined = [segments[0]]
+  for seg in segments[1:]:
+    prev = joined[-1]
+    if seg[0] == 'line' and prev[0] == 'line':
+      ax, ay = prev[3] - prev[1], prev[4] - prev[2]
+      bx, by = seg[3] - seg[1], seg[4] - seg[2]
+      if abs(ax * by - ay * bx) < 1.0e-6 and ax * bx + ay * by > 0:
+        prev[3] = seg[3]
+        prev[4] = seg[4]
+        continue
+    joined.append(seg)
+  return joined
+
+def merge_connectors(shapes):
+  '''Merge chains of touching lines and arcs into PathShape objects
+
+  Connectors are chained wherever exactly two of them with the same width meet
+  at a point. Junctions of three or more connectors end a chain. Lines with an
+  arrow are left alone so that every arrowhead is drawn the same way by each
+  backend. Collinear lines within a chain are combined. A merged path takes
+  the place of the first of its members in the paint order.
+
+  Returns a new list of shapes.
+  '''
+  def key(pt):
+    return (round(pt[0], 2), round(pt[1], 2))
+
+  def width(i):
+    return shapes[i].options.get('width', 2.0)
+
+  segs = {}
+  ends = collections.defaultdict(list)
+  for i, s in enumerate(shapes):
+    if not is_connector(s) or isinstance(s, PathShape) or s.options.get('arrow', None) is not None:
+      continue
+    seg = connector_segment(s)
+    p0, p1 = segment_ends(seg)
+    if key(p0) == key(p1): # Degenerate segment
+      continue
+    segs[i] = seg
+    ends[key(p0)].append(i)
+    ends[key(p1)].append(i)
+
+  def neighbor(i, pt):
+    # Find the one connector continuing from connector i at pt
+    joined = ends[key(pt)]
+    if len(joined) != 2:
+      return None
+    j = joined[0] if joined[1] == i else joined[1]
+    if j in used or width(j) != width(i):
+      return None
+    return j
+
+  used = set()
+  consumed = set()
+  paths = {} # Index of first member -> PathShape
+  for i in sorted(segs.iterkeys()):
+    if i in used:
+      continue
+    used.add(i)
+    chain = [i]
+    path = [segs[i]]
+
+    # Extend forward from the end
+    cur = i
+    while True:
+      pt = segment_ends(path[-1])[1]
+      j = neighbor(cur, pt)
+      if j is None:
+        break
+      seg = segs[j]
+      if key(segment_ends(seg)[0]) != key(pt):
+        seg = reverse_segment(seg)
+      used.add(j)
+      chain.append(j)
+      path.append(seg)
+      cur = j
+
+    # Extend backward from the start
+    cur = i
+    while True:
+      pt = segment_ends(path[0])[0]
+      j = neighbor(cur, pt)
+      if j is None:
+        break
+      seg = segs[j]
+      if key(segment_ends(seg)[1]) != key(pt):
+        seg = reverse_segment(seg)
+      used.add(j)
+      chain.insert(0, j)
+      path.insert(0, seg)
+      cur = j
+
+    if len(chain) < 2:
+      continue
+
+    path = [list(seg) for seg in path]
+    path = join_collinear(path)
+
+    boxes = zip(*[shapes[j].bbox for j in chain])
+    bbox = (min(boxes[0]), min(boxes[1]), max(boxes[2]), max(boxes[3]))
+    tags = set()
+    for j in chain:
+      tags |= shapes[j].tags
+
+    options = {'width': width(i), 'tags': tags}
+    paths[min(chain)] = PathShape(path, bbox, options)
+    consumed.update(chain)
+
+  merged = []
+  for i, s in enumerate(shapes):
+    if i in paths:
+      merged.append(paths[i])
+    elif i not in consumed:
+      merged.append(s)
+  return merged
+
+
+def arrow_polygon(head, tail, width):
+  '''Compute the outline of an arrowhead with its point at head'''
+  angle = math.atan2(head[1] - tail[1], head[0] - tail[0])
+  cos_a = math.cos(angle)
+  sin_a = math.sin(angle)
+
+  # Arrow at 0,0 with point facing right
   apath = [(-4,0), (-4.5,2), (0,0)]
 
   mirror = [(x,-y) for x, y in reversed(apath[1:-1])] # Mirror central points
   apath.extend(mirror)
 
+  # Scale, rotate, and move into position
+  return [(head[0] + width * (x * cos_a - y * sin_a), head[1] + width * (x * sin_a + y * cos_a)) \
+    for x, y in apath]
+
+def cairo_arrow_path(head, tail, c):
+  '''Add an arrowhead to the current path without filling it'''
+  apath = arrow_polygon(head, tail, c.get_line_width())
+
   c.move_to(*apath[0])
   for p in apath[1:]:
     c.line_to(*p)
   c.close_path()
 
+def cairo_draw_arrow(head, tail, fill, c):
+  cairo_arrow_path(head, tail, c)
   c.set_source_rgba(*fill)
   c.fill()
 
-  c.restore()
+def cairo_line_path(shape, c):
+  '''Add a line segment to the current path without stroking it
+
+  Returns the (head, tail) points for an arrowhead or None if the line has no arrow.
+  '''
+  x0, y0, x1, y1 = shape.points
+
+  if 'arrow' not in shape.options or shape.options['arrow'] is None:
+    c.move_to(x0,y0)
+    c.line_to(x1,y1)
+    return None
+
+  if shape.options['arrow'] == 'first':
+    head = x0, y0
+    tail = x1, y1
+  else: # Last
+    head = x1, y1
+    tail = x0, y0
+
+  # Adjust head point to show gaps between lines
+  length = math.sqrt(abs(x1 - x0)**2 + abs(y1 - y0)**2)
+  length -= 3
+  angle = math.atan2(head[1] - tail[1], head[0] - tail[0])
+
+  c.move_to(*tail)
+  c.line_to(tail[0] + length * math.cos(angle), tail[1] + length * math.sin(angle))
+  return (head, tail)
+
+def cairo_arc_path(shape, c):
+  '''Add an arc segment to the current path without stroking it'''
+  x0, y0, x1, y1 = shape.points
+  xc = (x0 + x1) / 2
+  yc = (y0 + y1) / 2
+  rad = (x1 - x0) / 2
+
+  start = shape.options['start']
+  extent = shape.options['extent']
+
+  # Start and end angles
+  sa = -math.radians(start)
+  ea = -math.radians(start + extent)
+
+  # Tk has opposite angle convention from Cairo
+  #   Positive extent is a negative rotation in Cairo
+  #   Negative extent is a positive rotation in Cairo
+  c.new_sub_path()
+  if extent >= 0:
+    c.arc_negative(xc,yc, rad, sa, ea)
+  else:
+    c.arc(xc,yc, rad, sa, ea)
+
+
+def cairo_path_path(shape, c):
+  '''Add the segments of a PathShape to the current path without stroking it'''
+  for i, seg in enumerate(shape.segments):
+    if seg[0] == 'line':
+      _, x0, y0, x1, y1 = seg
+      if i == 0:
+        c.move_to(x0,y0)
+      else:
+        c.line_to(x0,y0)
+      c.line_to(x1,y1)
+
+    else: # Arc
+      _, xc, yc, rad, start, extent = seg
+      sa = -math.radians(start)
+      ea = -math.radians(start + extent)
+      if extent >= 0:
+        c.arc_negative(xc,yc, rad, sa, ea)
+      else:
+        c.arc(xc,yc, rad, sa, ea)
+
 
 def cairo_draw_text(x, y, text, font, text_color, c):
-  c.save()
-  #print('## TEXT COLOR:', text_color)
-  c.set_source_rgba(*rgb_to_cairo(text_color))
-  font = cairo_font(font)
-
-  c.translate(x, y)
-
-  if use_pygobject:
-    layout = pangocairo.create_layout(c)
-    pctx = layout.get_context()
-    fo = cairo.FontOptions()
-    fo.set_antialias(cairo.ANTIALIAS_SUBPIXEL)
-    pangocairo.context_set_font_options(pctx, fo)
-    layout.set_font_description(font)
-    layout.set_text(text, len(text))
-    pangocairo.update_layout(c, layout)
-    pangocairo.show_layout(c, layout)
-
-  else: # pyGtk
-    pctx = pangocairo.CairoContext(c)
-    pctx.set_antialias(cairo.ANTIALIAS_SUBPIXEL)
-    layout = pctx.create_layout()
-    layout.set_font_description(font)
-    layout.set_text(text)
-    pctx.update_layout(layout)
-    pctx.show_layout(layout)
-
-  c.restore()
+  cairo = load_backend('cairo')
+  _, pangocairo, use_pygobject = load_backend('pango')
+
+  with pango_lock:
+    c.save()
+    #print('## TEXT COLOR:', text_color)
+    c.set_source_rgba(*rgb_to_cairo(text_color))
+    font = cairo_font(font)
+
+    c.translate(x, y)
+
+    if use_pygobject:
+      layout = pangocairo.create_layout(c)
+      pctx = layout.get_context()
+      fo = cairo.FontOptions()
+      fo.set_antialias(cairo.ANTIALIAS_SUBPIXEL)
+      pangocairo.context_set_font_options(pctx, fo)
+      layout.set_font_description(font)
+      layout.set_text(text, len(text))
+      pangocairo.update_layout(c, layout)
+      pangocairo.show_layout(c, layout)
+
+    else: # pyGtk
+      pctx = pangocairo.CairoContext(c)
+      pctx.set_antialias(cairo.ANTIALIAS_SUBPIXEL)
+      layout = pctx.create_layout()
+      layout.set_font_description(font)
+      layout.set_text(text)
+      pctx.update_layout(layout)
+      pctx.show_layout(layout)
+
+    c.restore()
 
 
 def cairo_draw_shape(shape, c, styles):
@@ -517,36 +1091,16 @@ def cairo_draw_shape(shape, c, styles):
     cairo_draw_text(x0, y0, shape.options['text'], shape.options['font'], text_color, c)
 
   elif isinstance(shape, LineShape):
-    x0, y0, x1, y1 = shape.points
-
-    if 'arrow' not in shape.options or shape.options['arrow'] is None:
-      c.move_to(x0,y0)
-      c.line_to(x1,y1)
-      c.stroke()
-
-    else: # Draw line with arrowhead
-      if shape.options['arrow'] == 'first':
-        head = x0, y0
-        tail = x1, y1
-      else: # Last
-        head = x1, y1
-        tail = x0, y0
-
-      # Adjust head point to show gaps between lines
-      length = math.sqrt(abs(x1 - x0)**2 + abs(y1 - y0)**2)
-      length -= 3
-      angle = math.atan2(head[1] - tail[1], head[0] - tail[0])
-      #print('# LEN:', length, angle * 180 / math.pi)
+    arrow = cairo_line_path(shape, c)
+    c.stroke()
 
-      c.save()
-      c.translate(*tail)
-      c.rotate(angle)
-      c.move_to(0,0)
-      c.line_to(length,0)
-      c.stroke()
-      c.restore()
+    if arrow is not None: # Draw arrowhead
+      cairo_draw_arrow(arrow[0], arrow[1], default_pen, c)
 
-      cairo_draw_arrow(head, tail, default_pen, c)
+  elif isinstance(shape, PathShape):
+    c.new_path()
+    cairo_path_path(shape, c)
+    c.stroke()
 
   elif isinstance(shape, RectShape):
     x0, y0, x1, y1 = shape.points
@@ -760,11 +1314,7 @@ def cairo_draw_shape(shape, c, styles):
       c.fill()
 
     # Stroke arc segment
-    c.new_sub_path()
-    if extent >= 0:
-      c.arc_negative(xc,yc, rad, sa, ea)
-    else:
-      c.arc(xc,yc, rad, sa, ea)
+    cairo_arc_path(shape, c)
 
     c.set_source_rgba(*default_pen)
     c.stroke()
@@ -781,6 +1331,49 @@ def cairo_draw_shape(shape, c, styles):
 #    c.stroke()
 
 
+def cairo_draw_shapes(shapes, c, styles):
+  '''Draw a list of shapes in order
+
+  Runs of consecutive connectors with the same line width are collected into
+  a single path that is stroked once. Their arrowheads are filled together
+  after the stroke. Paint order relative to other shapes is preserved.
+  '''
+  default_pen = rgb_to_cairo(styles.line_color)
+
+  i = 0
+  while i < len(shapes):
+    shape = shapes[i]
+    if not is_connector(shape):
+      cairo_draw_shape(shape, c, styles)
+      i += 1
+      continue
+
+    width = shape.options['width'] if 'width' in shape.options else 2.0
+    c.set_line_width(width)
+
+    arrows = []
+    while i < len(shapes) and is_connector(shapes[i]) and \
+        shapes[i].options.get('width', 2.0) == width:
+      if isinstance(shapes[i], LineShape):
+        arrow = cairo_line_path(shapes[i], c)
+        if arrow is not None:
+          arrows.append(arrow)
+      elif isinstance(shapes[i], PathShape):
+        c.new_sub_path()
+        cairo_path_path(shapes[i], c)
+      else:
+        cairo_arc_path(shapes[i], c)
+      i += 1
+
+    c.set_source_rgba(*default_pen)
+    c.stroke()
+
+    if len(arrows) > 0:
+      for head, tail in arrows:
+        cairo_arrow_path(head, tail, c)
+      c.fill()
+
+
 def xml_escape(txt):
     txt = txt.replace('&', '&amp;')
     txt = txt.replace('<', '&lt;')
@@ -789,7 +1382,94 @@ def xml_escape(txt):
     return txt
 
 
-def svg_draw_shape(shape, fh, styles):
+class SvgFormat(object):
+  '''Output settings for the SVG backend
+
+  In compact mode coordinates are rounded to a fixed number of decimal
+  places, presentation attributes are replaced with generated CSS classes,
+  and elements are written without separating newlines.
+
+  With dedup enabled, nodes that appear more than once are written as
+  a <symbol> and each instance is a <use> reference to it.
+  '''
+  def __init__(self, compact=False, precision=2, dedup=False, id_prefix=''):
+    self.compact = compact
+    self.precision = precision
+    self.dedup = dedup
+    self.id_prefix = id_prefix # Keeps ids unique when several diagrams share a document
+    self.classes = collections.OrderedDict() # Attribute items -> class name
+
+  def num(self, v):
+    '''Format a coordinate'''
+    if not self.compact:
+      return v
+
+    txt = '{:.{}f}'.format(v, self.precision)
+    if '.' in txt:
+      txt = txt.rstrip('0').rstrip('.')
+    if txt == '-0':
+      txt = '0'
+    return txt
+
+  def attributes(self, attrs):
+    '''Convert a dict of presentation attributes into element attributes'''
+    if not self.compact:
+      return ' '.join(['{}="{}"'.format(k,v) for k,v in attrs.iteritems()])
+
+    key = tuple(sorted(attrs.iteritems()))
+    if key not in self.classes:
+      self.classes[key] = 's{}'.format(len(self.classes))
+    return 'class="{}"'.format(self.classes[key])
+
+  def line(self, txt):
+    '''Terminate an element'''
+    return txt if self.compact else txt + u'\n'
+
+  def css(self):
+    '''Generate CSS for the classes created by attributes()'''
+    css = []
+    for key, name in self.classes.iteritems():
+      props = ';'.join('{}:{}'.format(k,v) for k,v in key)
+      css.append('.{}{{{}}}'.format(name, props))
+    return '\n'.join(css)
+
+  def minify(self, txt):
+    '''Strip insignificant whitespace from fixed markup'''
+    if not self.compact:
+      return txt
+
+    txt = re.sub(r'>\s+<', '><', txt)
+    return re.sub(r'\s*\n\s*', ' ', txt).strip()
+
+
+def svg_draw_text(x, y, text, font_name, href, fh, fmt):
+  n = fmt.num
+  txt = xml_escape(text)
+  if href is not None: # Hyperlink
+    fh.write(u'<a xlink:href="{}" target="_parent">'.format(href))
+    if not fmt.compact:
+      fh.write(u'\n  ')
+    fh.write(fmt.line(u'<text class="{} link" x="{}" y="{}">{}</text></a>'.format(font_name,
+      n(x), n(y), txt)))
+  else:
+    fh.write(fmt.line(u'<text class="{}" x="{}" y="{}">{}</text>'.format(font_name, n(x), n(y), txt)))
+
+def svg_draw_bubble_text(shape, fh, fmt):
+  x0, y0, x1, y1 = shape.points
+  x, y = shape.options['text_pos']
+  th = abs(y)
+  x = (x0 + x1) / 2 # Center in bubble
+  y = ((y0 + y1) / 2) + th / 2
+
+  href = shape.options.get('href', None)
+  svg_draw_text(x, y, shape.options['text'], shape.options['font_name'], href, fh, fmt)
+
+
+def svg_draw_shape(shape, fh, styles, fmt=None):
+  if fmt is None:
+    fmt = SvgFormat()
+  n = fmt.num
+
   default_pen = rgb_to_hex(styles.line_color)
 
   if 'width' in shape.options:
@@ -818,9 +1498,7 @@ def svg_draw_shape(shape, fh, styles):
     x = (x0 + x1) / 2 # Center text
     y = y1 - 10 # FIXME: Adjust for baseline offset
 
-    font_name = shape.options['font_name']
-    fh.write(u'<text class="{}" x="{}" y="{}">{}</text>\n'.format(font_name, x, y,
-      xml_escape(shape.options['text'])))
+    svg_draw_text(x, y, shape.options['text'], shape.options['font_name'], None, fh, fmt)
 
   elif isinstance(shape, LineShape):
     x0, y0, x1, y1 = shape.points
@@ -828,13 +1506,13 @@ def svg_draw_shape(shape, fh, styles):
     # We don't need a fill attribute for lines
     del attrs['fill']
 
-    attributes = ' '.join(['{}="{}"'.format(k,v) for k,v in attrs.iteritems()])
-
     if 'arrow' not in shape.options or shape.options['arrow'] is None:
-      fh.write(u'<line x1="{}" y1="{}" x2="{}" y2="{}" {} />\n'.format(
-        x0,y0,x1,y1, attributes))
+      attributes = fmt.attributes(attrs)
+      fh.write(fmt.line(u'<line x1="{}" y1="{}" x2="{}" y2="{}" {} />'.format(
+        n(x0),n(y0),n(x1),n(y1), attributes)))
     else: # Draw line with arrowhead
-      attributes += ' marker-end="url(#arrow)"'
+      attrs['marker-end'] = 'url(#arrow)'
+      attributes = fmt.attributes(attrs)
 
       if shape.options['arrow'] == 'first':
         head = x0, y0
@@ -850,24 +1528,45 @@ def svg_draw_shape(shape, fh, styles):
 
       head = (tail[0] + length * math.cos(angle), tail[1] + length * math.sin(angle))
 
-      fh.write(u'<line x1="{}" y1="{}" x2="{}" y2="{}" {} />\n'.format(
-        tail[0],tail[1],head[0],head[1], attributes))
+      fh.write(fmt.line(u'<line x1="{}" y1="{}" x2="{}" y2="{}" {} />'.format(
+        n(tail[0]),n(tail[1]),n(head[0]),n(head[1]), attributes)))
+
+  elif isinstance(shape, PathShape):
+    attrs['fill'] = 'none'
+
+    attributes = fmt.attributes(attrs)
+
+    d = []
+    for i, seg in enumerate(shape.segments):
+      start, end = segment_ends(seg)
+      if i == 0:
+        d.append('M{},{}'.format(n(start[0]), n(start[1])))
+
+      if seg[0] == 'line':
+        d.append('L{},{}'.format(n(end[0]), n(end[1])))
+      else: # Arc
+        rad = seg[3]
+        extent = seg[5]
+        large = 1 if abs(extent) > 180 else 0
+        sweep = 0 if extent >= 0 else 1 # Positive Tk extent is CCW
+        d.append('A{},{} 0 {},{} {},{}'.format(n(rad),n(rad), large,sweep, n(end[0]),n(end[1])))
+
+    fh.write(fmt.line(u'<path d="{}" {}/>'.format(' '.join(d), attributes)))
 
 
   elif isinstance(shape, RectShape):
     x0, y0, x1, y1 = shape.points
-    #c.rectangle(x0,y0, x1-x0,y1-y0)
 
-    attributes = ' '.join(['{}="{}"'.format(k,v) for k,v in attrs.iteritems()])
+    attributes = fmt.attributes(attrs)
 
-    fh.write(u'<rect x="{}" y="{}" width="{}" height="{}" {}/>\n'.format(
-      x0,y0, x1-x0, y1-y0, attributes))
+    fh.write(fmt.line(u'<rect x="{}" y="{}" width="{}" height="{}" {}/>'.format(
+      n(x0),n(y0), n(x1-x0), n(y1-y0), attributes)))
 
 
   elif isinstance(shape, BubbleShape):
     x0, y0, x1, y1 = shape.points
 
-    attributes = ' '.join(['{}="{}"'.format(k,v) for k,v in attrs.iteritems()])
+    attributes = fmt.attributes(attrs)
 
     rad = (y1 - y0) / 2.0
     left = x0 + rad
@@ -877,30 +1576,19 @@ def svg_draw_shape(shape, fh, styles):
     yc = (y0 + y1) / 2.0
 
     if abs(right - left) <= 1: # Circular bubble
-      fh.write(u'<circle cx="{}" cy="{}" r="{}" {}/>\n'.format(xc, yc, rad, attributes))
+      fh.write(fmt.line(u'<circle cx="{}" cy="{}" r="{}" {}/>'.format(n(xc), n(yc), n(rad), attributes)))
     else: # Rounded box
-      fh.write(u'<path d="M{},{} A{},{} 0 0,1 {},{} H{} A{},{} 0 0,1 {},{} z" {}/>\n'.format(left,y1, rad,rad,left,y0, right, rad,rad,right,y1,  attributes))
+      fh.write(fmt.line(u'<path d="M{},{} A{},{} 0 0,1 {},{} H{} A{},{} 0 0,1 {},{} z" {}/>'.format(
+        n(left),n(y1), n(rad),n(rad),n(left),n(y0), n(right), n(rad),n(rad),n(right),n(y1),  attributes)))
 
     # Add the text
     if 'text' in shape.options:
-      x, y = shape.options['text_pos']
-      th = abs(y)
-  #    y += (y0 + y1) / 2
-      x = (x0 + x1) / 2 # Center in bubble
-      y = ((y0 + y1) / 2) + th / 2
-
-      txt = xml_escape(shape.options['text'])
-      font_name = shape.options['font_name']
-      if 'href' in shape.options and shape.options['href'] is not None: # Hyperlink
-        href = shape.options['href']
-        fh.write(u'<a xlink:href="{}" target="_parent">\n  <text class="{} link" x="{}" y="{}">{}</text></a>\n'.format(href, font_name, x, y, txt))
-      else:
-        fh.write(u'<text class="{}" x="{}" y="{}">{}</text>\n'.format(font_name, x, y, txt))
+      svg_draw_bubble_text(shape, fh, fmt)
 
   elif isinstance(shape, HexBubbleShape):
     x0, y0, x1, y1 = shape.points
 
-    attributes = ' '.join(['{}="{}"'.format(k,v) for k,v in attrs.iteritems()])
+    attributes = fmt.attributes(attrs)
 
     rad = (y1 - y0) / 2.0
     left = x0 + rad
@@ -914,48 +1602,25 @@ def svg_draw_shape(shape, fh, styles):
       left = xc
       right = xc
 
-    fh.write(u'<path d="M{},{} H{} L{},{} L{},{} H{} L{},{} z" {}/>\n'.format(left-rpad,y1,
-    right+rpad, right+rad,yc, right+rpad,y0, left-rpad, left-rad,yc,  attributes))
+    fh.write(fmt.line(u'<path d="M{},{} H{} L{},{} L{},{} H{} L{},{} z" {}/>'.format(n(left-rpad),n(y1),
+      n(right+rpad), n(right+rad),n(yc), n(right+rpad),n(y0), n(left-rpad), n(left-rad),n(yc),  attributes)))
 
     # Add the text
     if 'text' in shape.options:
-      x, y = shape.options['text_pos']
-      th = abs(y)
-  #    y += (y0 + y1) / 2
-      x = (x0 + x1) / 2 # Center in bubble
-      y = ((y0 + y1) / 2) + th / 2
-
-      txt = xml_escape(shape.options['text'])
-      font_name = shape.options['font_name']
-      if 'href' in shape.options and shape.options['href'] is not None: # Hyperlink
-        href = shape.options['href']
-        fh.write(u'<a xlink:href="{}" target="_parent">\n  <text class="{} link" x="{}" y="{}">{}</text></a>\n'.format(href, font_name, x, y, txt))
-      else:
-        fh.write(u'<text class="{}" x="{}" y="{}">{}</text>\n'.format(font_name, x, y, txt))
+      svg_draw_bubble_text(shape, fh, fmt)
 
 
   elif isinstance(shape, BoxBubbleShape):
     x0, y0, x1, y1 = shape.points
 
-    attributes = ' '.join(['{}="{}"'.format(k,v) for k,v in attrs.iteritems()])
+    attributes = fmt.attributes(attrs)
 
-    fh.write(u'<rect x="{}" y="{}" width="{}" height="{}" {}/>\n'.format(
-      x0,y0, x1-x0, y1-y0, attributes))
+    fh.write(fmt.line(u'<rect x="{}" y="{}" width="{}" height="{}" {}/>'.format(
+      n(x0),n(y0), n(x1-x0), n(y1-y0), attributes)))
 
     # Add the text
     if 'text' in shape.options:
-      x, y = shape.options['text_pos']
-      th = abs(y)
-      #y += (y0 + y1) / 2
-      x = (x0 + x1) / 2 # Center in bubble
-      y = ((y0 + y1) / 2) + th / 2
-
-      txt = xml_escape(shape.options['text'])
-      font_name = shape.options['font_name']
-      if 'href' in shape.options and shape.options['href'] is not None: # Hyperlink
-        fh.write(u'<a xlink:href="{}" target="_parent">\n  <text class="{} link" x="{}" y="{}">{}</text></a>\n'.format(shape.options['href'], font_name, x, y, txt))
-      else:
-        fh.write(u'<text class="{}" x="{}" y="{}">{}</text>\n'.format(font_name, x, y, txt))
+      svg_draw_bubble_text(shape, fh, fmt)
 
   elif isinstance(shape, OvalShape):
     x0, y0, x1, y1 = shape.points
@@ -963,9 +1628,9 @@ def svg_draw_shape(shape, fh, styles):
     yc = (y0 + y1) / 2
     rad = (x1 - x0) / 2
 
-    attributes = ' '.join(['{}="{}"'.format(k,v) for k,v in attrs.iteritems()])
+    attributes = fmt.attributes(attrs)
 
-    fh.write(u'<circle cx="{}" cy="{}" r="{}" {}/>\n'.format(xc, yc, rad, attributes))
+    fh.write(fmt.line(u'<circle cx="{}" cy="{}" r="{}" {}/>'.format(n(xc), n(yc), n(rad), attributes)))
 
 
   elif isinstance(shape, ArcShape):
@@ -988,15 +1653,221 @@ def svg_draw_shape(shape, fh, styles):
 
     attrs['fill'] = 'none'
 
-    attributes = ' '.join(['{}="{}"'.format(k,v) for k,v in attrs.iteritems()])
+    attributes = fmt.attributes(attrs)
 
     xs = xc + rad * math.cos(sa)
     ys = yc - rad * math.sin(sa)
     xe = xc + rad * math.cos(ea)
     ye = yc - rad * math.sin(ea)
 
-    fh.write(u'<path d="M{},{} A{},{} 0 0,0 {},{}" {}/>\n'.format(xs,ys, rad,rad, xe,ye, attributes))
+    fh.write(fmt.line(u'<path d="M{},{} A{},{} 0 0,0 {},{}" {}/>'.format(n(xs),n(ys), n(rad),n(rad),
+      n(xe),n(ye), attributes)))
+
+
+def svg_node_markup(shape, styles, fmt):
+  '''Draw a node positioned at the origin so that repeated nodes can be found
+
+  Returns None for shapes that can't be shared.
+  '''
+  if not isinstance(shape, (BubbleShape, BoxBubbleShape, HexBubbleShape)):
+    return None
+  if shape.options.get('href', None) is not None: # Keep hyperlinks in the main document
+    return None
+
+  x0, y0 = shape.points[:2]
+  node = copy.deepcopy(shape)
+  node.move(-x0, -y0)
+
+  body = io.StringIO()
+  svg_draw_shape(node, body, styles, fmt)
+  return body.getvalue()
+
+def svg_draw_shapes(shapes, fh, styles, fmt):
+  '''Draw a list of shapes in order
+
+  When fmt.dedup is set, nodes with identical markup relative to their origin
+  are written once as a <symbol> in <defs> and referenced with <use> elements.
+  '''
+  symbols = {} # Node markup -> symbol id
+
+  if fmt.dedup:
+    markup = [svg_node_markup(s, styles, fmt) for s in shapes]
+    counts = collections.Counter(markup)
+
+    defs = []
+    for m in markup:
+      if m is None or counts[m] < 2 or m in symbols:
+        continue
+
+      sid = '{}n{}'.format(fmt.id_prefix, len(symbols))
+      symbols[m] = sid
 
+      defs.append(fmt.line(u'<symbol id="{}" overflow="visible">'.format(sid)))
+      defs.append(m)
+      defs.append(fmt.line(u'</symbol>'))
+
+    if len(defs) > 0:
+      fh.write(fmt.line(u'<defs>'))
+      fh.write(u''.join(defs))
+      fh.write(fmt.line(u'</defs>'))
+  else:
+    markup = [None] * len(shapes)
+
+  for s, m in zip(shapes, markup):
+    if m in symbols:
+      x0, y0 = s.points[:2]
+      fh.write(fmt.line(u'<use xlink:href="#{}" x="{}" y="{}"/>'.format(symbols[m],
+        fmt.num(x0), fmt.num(y0))))
+    else:
+      svg_draw_shape(s, fh, styles, fmt)
+
+
+# Shape kinds output by json_draw_shapes(). Clients draw in the order of the z arrays.
+json_shape_kinds = ('rects', 'lines', 'arcs', 'paths', 'ovals', 'bubbles', 'boxes', 'hexes',
+  'arrows', 'texts')
+
+def json_draw_shapes(shapes, styles, precision=2):
+  '''Convert shapes into compact geometry for drawing on the client side
+
+  Shapes are grouped by kind into flat coordinate arrays that can be loaded
+  straight into typed arrays. Per-shape indices refer to the shared style,
+  text, font, and href tables. Missing text and hrefs are -1. Each kind has a
+  z array with the position of its shapes in the paint order. Arrowheads
+  have the z of their line and are painted just after it.
+
+    lines                   x0,y0,x1,y1
+    arcs                    xc,yc,rad,a0,a1 (radians, y down, anticlockwise when a1 < a0)
+    paths                   data of 0,x,y (move), 1,x,y (line), 2,xc,yc,rad,a0,a1 (arc)
+                            with the offset of each path in start
+    rects, ovals, bubbles,
+    boxes, hexes            x0,y0,x1,y1
+    arrows                  polygon x,y pairs for each filled arrowhead
+    texts                   x,y of the text baseline center
+
+  Returns a dict ready for JSON encoding.
+  '''
+  def q(v):
+    v = round(v, precision)
+    return int(v) if v == int(v) else v
+
+  kinds = dict((k, collections.defaultdict(list)) for k in json_shape_kinds)
+  line_color = rgb_to_hex(styles.line_color)
+
+  tables = {'styles': [], 'text': [], 'fonts': [], 'hrefs': []}
+  index = dict((k, {}) for k in tables)
+
+  def table_id(table, value, key=None):
+    if value is None:
+      return -1
+    if key is None:
+      key = value
+    if key not in index[table]:
+      index[table][key] = len(tables[table])
+      tables[table].append(value)
+    return index[table][key]
+
+  fonts = style_fonts(styles)
+  def font_id(shape):
+    family, size, weight, style, color = fonts[shape.options['font_name']]
+    return table_id('fonts', {'family': family, 'size': size, 'weight': weight, 'style': style,
+      'color': color}, shape.options['font_name'])
+
+  def style_id(shape, filled=True):
+    width = shape.options.get('width', 2.0)
+    style = {'stroke': line_color if width > 0 else None, 'width': q(width)}
+    if filled:
+      fill = shape.options.get('fill', (255,255,255))
+      style['fill'] = rgb_to_hex(fill)
+      if len(fill) == 4:
+        style['fill_opacity'] = q(fill[3] / 255.0)
+    return table_id('styles', style, tuple(sorted(style.iteritems())))
+
+  def add_arrow(head, tail, width, z):
+    apath = arrow_polygon(head, tail, width)
+    kinds['arrows']['coords'].extend(q(v) for pt in apath for v in pt)
+    kinds['arrows']['z'].append(z)
+
+  def angles(start, extent):
+    # Tk angles are CCW with y up
+    return q(-math.radians(start)), q(-math.radians(start + extent))
+
+  for z, s in enumerate(shapes):
+    width = s.options.get('width', 2.0)
+    x0, y0, x1, y1 = s.points
+
+    if isinstance(s, TextShape):
+      k = kinds['texts']
+      k['coords'].extend((q((x0 + x1) / 2), q(y1 - 10)))
+      k['text'].append(table_id('text', s.options['text']))
+      k['font'].append(font_id(s))
+      k['z'].append(z)
+
+    elif isinstance(s, LineShape):
+      arrow = s.options.get('arrow', None)
+      if arrow is not None:
+        if arrow == 'first':
+          head, tail = (x0, y0), (x1, y1)
+        else: # Last
+          head, tail = (x1, y1), (x0, y0)
+        add_arrow(head, tail, width, z)
+
+        # Pull the line back under the arrowhead
+        seg = ['line', tail[0], tail[1], head[0], head[1]]
+        shorten_line(seg, False, 3)
+        x0, y0, x1, y1 = seg[1:]
+
+      k = kinds['lines']
+      k['coords'].extend((q(x0), q(y0), q(x1), q(y1)))
+      k['style'].append(style_id(s, False))
+      k['z'].append(z)
+
+    elif isinstance(s, ArcShape):
+      k = kinds['arcs']
+      k['coords'].extend((q((x0 + x1) / 2), q((y0 + y1) / 2), q((x1 - x0) / 2)) + \
+        angles(s.options['start'], s.options['extent']))
+      k['style'].append(style_id(s, False))
+      k['z'].append(z)
+
+    elif isinstance(s, PathShape):
+      k = kinds['paths']
+      k['start'].append(len(k['data']))
+      for i, seg in enumerate(s.segments):
+        start, end = segment_ends(seg)
+        if i == 0:
+          k['data'].extend((0, q(start[0]), q(start[1])))
+
+        if seg[0] == 'line':
+          k['data'].extend((1, q(end[0]), q(end[1])))
+        else: # Arc
+          _, xc, yc, rad, a_start, a_extent = seg
+          k['data'].extend((2, q(xc), q(yc), q(rad)) + angles(a_start, a_extent))
+      k['style'].append(style_id(s, False))
+      k['z'].append(z)
+
+    else:
+      kind = {RectShape: 'rects', OvalShape: 'ovals', BubbleShape: 'bubbles',
+        BoxBubbleShape: 'boxes', HexBubbleShape: 'hexes'}[type(s)]
+      k = kinds[kind]
+      k['coords'].extend((q(x0), q(y0), q(x1), q(y1)))
+      k['style'].append(style_id(s))
+      k['z'].append(z)
+
+      if kind in ('bubbles', 'boxes', 'hexes'):
+        if 'text' in s.options:
+          th = abs(s.options['text_pos'][1])
+          k['text_pos'].extend((q((x0 + x1) / 2), q((y0 + y1) / 2 + th / 2))) # Center in node
+          k['text'].append(table_id('text', s.options['text']))
+          k['font'].append(font_id(s))
+        else: # Shadow
+          k['text_pos'].extend((0, 0))
+          k['text'].append(-1)
+          k['font'].append(-1)
+        k['href'].append(table_id('hrefs', s.options.get('href', None)))
+
+  geometry = {'shapes': dict((k, dict(kinds[k])) for k in json_shape_kinds if len(kinds[k]) > 0)}
+  geometry['arrow_fill'] = line_color
+  geometry.update(tables)
+  return geometry
 
 
 class RailCanvas(object):
@@ -1007,6 +1878,7 @@ class RailCanvas(object):
   def __init__(self, text_bbox=cairo_text_bbox):
     self.text_bbox = text_bbox
     self.shapes = []
+    self.text_id = 1 # Text ids are unique to each canvas
 
 
   def _get_shapes(self, item=None):
@@ -1050,8 +1922,8 @@ class RailCanvas(object):
     self.shapes.append(shape)
 
     # Add a unique tag to serve as an ID
-    id_tag = 'id' + str(TextShape.text_id)
-    TextShape.text_id += 1
+    id_tag = 'id' + str(self.text_id)
+    self.text_id += 1
     shape.tags.add(id_tag)
     return id_tag
 
@@ -1103,8 +1975,76 @@ class RailCanvas(object):
 
 
 
+class LimitError(ValueError):
+  '''A diagram exceeded one of its RenderLimits'''
+  pass
+
+class SpecError(ValueError):
+  '''A spec file contains something other than diagram functions and literals'''
+  pass
+
+def spec_size(spec):
+  '''Count the elements in a spec and find its nesting depth
+
+  Returns (nodes, depth). The spec is walked without recursion so that
+  deeply nested input can be checked safely.
+  '''
+  nodes = 0
+  depth = 0
+  pending = [(spec, 1)]
+  while len(pending) > 0:
+    item, level = pending.pop()
+    nodes += 1
+    depth = max(depth, level)
+    if is_listy(item):
+      pending.extend((s, level + 1) for s in item)
+
+  return nodes, depth
+
+class RenderLimits(object):
+  '''Bounds on the work done to render a diagram
+
+  Limits that are None are not checked. time_budget is the number of seconds
+  allowed for layout. max_pixels limits the area of bitmap output. A
+  LimitError is raised as soon as a limit is exceeded.
+  '''
+  def __init__(self, max_nodes=None, max_depth=None, max_shapes=None, max_pixels=None, time_budget=None):
+    self.max_nodes = max_nodes
+    self.max_depth = max_depth
+    self.max_shapes = max_shapes
+    self.max_pixels = max_pixels
+    self.time_budget = time_budget
+
+  def check_spec(self, spec):
+    if self.max_nodes is None and self.max_depth is None:
+      return
+
+    nodes, depth = spec_size(spec)
+    self.check_count(nodes, depth)
+
+  def check_count(self, nodes, depth):
+    if self.max_nodes is not None and nodes > self.max_nodes:
+      raise LimitError('Spec has {} elements, more than the limit of {}'.format(nodes, self.max_nodes))
+    if self.max_depth is not None and depth > self.max_depth:
+      raise LimitError('Spec is nested {} levels deep, more than the limit of {}'.format(depth, self.max_depth))
+
+  def deadline(self):
+    '''Get the time when the layout budget expires'''
+    return None if self.time_budget is None else time.time() + self.time_budget
+
+  def check_layout(self, shape_count, deadline):
+    if self.max_shapes is not None and shape_count > self.max_shapes:
+      raise LimitError('Diagram has more than {} shapes'.format(self.max_shapes))
+    if deadline is not None and time.time() > deadline:
+      raise LimitError('Layout took longer than {} seconds'.format(self.time_budget))
+
+  def check_size(self, W, H):
+    if self.max_pixels is not None and W * H > self.max_pixels:
+      raise LimitError('Image size {}x{} is more than the limit of {} pixels'.format(W, H, self.max_pixels))
+
+
 class RailroadLayout(object):
-  def __init__(self, canvas, style, url_map=None):
+  def __init__(self, canvas, style, url_map=None, limits=None, subtree_cache=None):
     self.canvas = canvas
     self.tagcnt = 0
     self.style = style
@@ -1113,6 +2053,13 @@ class RailroadLayout(object):
       url_map = {}
     self.url_map = url_map
 
+    self.limits = limits
+    self.deadline = None if limits is None else limits.deadline()
+    self.subtree_cache = subtree_cache
+
+    # Wrap lines that don't fit in the image
+    self.max_width = None if style.max_width is None else style.max_width - 2*style.padding
+
   def get_tag(self, prefix='x', suffix=''):
     self.tagcnt += 1
     return '{}{}{}'.format(prefix, self.tagcnt, suffix)
@@ -1188,18 +2135,21 @@ class RailroadLayout(object):
 
   def format_text(self, txt):
     s = self.style
+    terminal = isinstance(txt, Terminal)
 
     # Default to first node style
     node_style = s.node_styles[0]
 
     # Check each node pattern for a match
     for ns in s.node_styles:
+      if terminal and ns.text_mod_func: # Terminals keep their text
+        continue
       if re.match(ns.pattern, txt):
         node_style = ns
         break
 
     # Apply any text transformation for this style
-    if ns.text_mod_func:
+    if ns.text_mod_func and not terminal:
       txt = ns.text_mod_func(txt)
 
     return (txt, node_style)
@@ -1212,7 +2162,7 @@ class RailroadLayout(object):
     if txt is None: # Line for skipped options
       c.create_line(0,0,1,0, width=s.outline_width, tags=(tag,))
       return [tag, 1, 0]
-    elif txt == 'bullet': # Small bullet
+    elif txt == 'bullet' and not isinstance(txt, Terminal): # Small bullet
       w = s.outline_width
       r = w+1
       c.create_oval(0,-r,2*r,r, width=s.outline_width, tags=(tag,), fill=s.bullet_fill)
@@ -1225,7 +2175,7 @@ class RailroadLayout(object):
       fill = node_style.fill
       text_color = node_style.text_color
 
-      if txt in self.url_map:
+      if txt in self.url_map and not isinstance(txt, Terminal):
         href = self.url_map[txt]
       else:
         href = None
@@ -1291,17 +2241,87 @@ class RailroadLayout(object):
   def draw_line(self, lx, ltor):
     '''Draw a series of elements from left to right'''
     tag = self.get_tag()
+
+    if ltor and self.max_width is not None: # Nested lines are wrapped along with this one
+      lx = flatten_line(lx)
+
+    terms = lx if ltor else reversed(lx) # Reverse so we can draw left to right
+    drawn = (self.draw_diagram(term, ltor) for term in terms) # Draw each element as it's joined
+
+    if ltor and self.max_width is not None:
+      drawn = list(drawn)
+      rows = self.line_breaks(drawn) if len(drawn) > 1 else [drawn]
+      if len(rows) > 1: # Stack the rows using the elements already drawn
+        rows = [self.join_line(self.get_tag(), row, ltor) for row in rows]
+        t, exx, exy = self.draw_stack(0, rows, ltor, predrawn=True)
+        self.canvas.addtag_withtag(tag, t)
+        self.canvas.dtag(t, t)
+        return [tag, exx, exy]
+
+    return self.join_line(tag, drawn, ltor)
+
+  def line_breaks(self, drawn):
+    '''Split the drawn elements of a line into rows no wider than max_width
+
+    The fewest rows are used with the breaks chosen to minimize the sum of
+    the squared space left at the end of each row but the last. Only the
+    measurements of the drawn elements are needed so nothing is laid out
+    again. Returns a list of rows of drawn elements.
+    '''
+    c = self.canvas
+    s = self.style
+
+    sep = s.h_sep
+    stack_sep = s.v_sep * 2
+    indent = stack_sep * 2 # Start of rows after the first in draw_stack()
+    turnback = stack_sep + s.max_radius # Space used after rows before the last
+
+    # Offset of each element from the start of its row
+    n = len(drawn)
+    offset = [0] * (n + 1)
+    for i, (t, exx, exy) in enumerate(drawn):
+      offset[i+1] = offset[i] + exx + sep
+    right = [c.bbox(t)[2] for t, exx, exy in drawn]
+
+    if offset[n-1] + right[n-1] <= self.max_width: # No need to wrap
+      return [drawn]
+
+    # best[j] is (rows, raggedness, start of last row) for the first j elements
+    best = [(0, 0, 0)] + [None] * n
+    for j in range(1, n+1):
+      for i in range(j-1, -1, -1):
+        span = offset[j-1] - offset[i] + right[j-1]
+        if span > self.max_width and i < j-1: # Adding more elements can only be wider
+          break
+
+        width = span + (indent if i > 0 else 0) + (turnback if j < n else 0)
+        slack = self.max_width - width
+        if slack < 0 and i < j-1: # A single element is allowed to overflow
+          continue
+        ragged = slack * slack if j < n and slack > 0 else 0
+        cost = (best[i][0] + 1, best[i][1] + ragged, i)
+        if best[j] is None or cost[:2] < best[j][:2]:
+          best[j] = cost
+
+    rows = []
+    j = n
+    while j > 0:
+      i = best[j][2]
+      rows.append(drawn[i:j])
+      j = i
+
+    return list(reversed(rows))
+
+  def join_line(self, tag, drawn, ltor):
+    '''Connect drawn elements from left to right'''
     c = self.canvas
     s = self.style
     
     sep = s.h_sep
     exx = 0
     exy = 0
-    
-    terms = lx if ltor else reversed(lx) # Reverse so we can draw left to right
 
-    for term in terms:
-      t, texx, texy = self.draw_diagram(term, ltor) # Draw each element
+    for t, texx, texy in drawn:
       if exx > 0: # Second element onward
         xn = exx + sep # Add space between elements
         c.move(t, xn, exy) # Shift last element forward
@@ -1325,7 +2345,7 @@ class RailroadLayout(object):
     return [tag, exx, exy] # Exit point
 
 
-  def draw_stack(self, indent, lx, ltor):
+  def draw_stack(self, indent, lx, ltor, predrawn=False):
     tag = self.get_tag()
     c = self.canvas
     s = self.style
@@ -1338,15 +2358,18 @@ class RailroadLayout(object):
     
     for term in lx:
       bypass_y = next_bypass_y
-      if i > 0 and i < n and len(term) > 1 and indent >= 0 and \
+      if not predrawn and i > 0 and i < n and len(term) > 1 and indent >= 0 and \
         (term[0] == 'opt' or term[0] == 'optx'):
         bypass = 1
         term = ['line', term[1:]]
       else:
         bypass = 0
         next_bypass_y = 0
-        
-      t, exx, exy = self.draw_diagram(term, ltor)
+
+      if predrawn: # Elements from draw_line() that only need to be placed
+        t, exx, exy = term
+      else:
+        t, exx, exy = self.draw_diagram(term, ltor)
       tx0, ty0, tx1, ty1 = c.bbox(t)
       
       if i == 0:
@@ -1666,6 +2689,14 @@ class RailroadLayout(object):
 
     
   def draw_diagram(self, spec, ltor):
+    if self.limits is not None:
+      self.limits.check_layout(len(self.canvas.shapes), self.deadline)
+
+    if self.subtree_cache is not None:
+      return self.subtree_cache.draw_cached(self, spec, ltor)
+    return self.draw_element(spec, ltor)
+
+  def draw_element(self, spec, ltor):
     if isinstance(spec, basestring):
       spec = [spec]
 
@@ -1745,11 +2776,19 @@ width="{}" height="{}" version="1.1">
 </defs>
 '''
 
-def render_railroad(spec, title, url_map, out_file, backend, styles, scale, transparent):
-  print('Rendering to {} using {} backend'.format(out_file, backend))
-  rc = RailCanvas(cairo_text_bbox)
+def layout_diagram(spec, title, url_map, styles, text_bbox=cairo_text_bbox, limits=None,
+    subtree_cache=None):
+  '''Position the elements of a diagram and its title
+
+  Returns the RailCanvas and bounding box like layout_railroad() without
+  preparing the shapes for drawing.
+  '''
+  if limits is not None:
+    limits.check_spec(spec)
+
+  rc = RailCanvas(text_bbox)
 
-  layout = RailroadLayout(rc, styles, url_map)
+  layout = RailroadLayout(rc, styles, url_map, limits, subtree_cache)
   layout.draw_diagram(spec, True)
 
   if title is not None: # Add title
@@ -1769,16 +2808,29 @@ def render_railroad(spec, title, url_map, out_file, backend, styles, scale, tran
 
     rc.move(tid, mx, my)
 
-  x0,y0,x1,y1 = rc.bbox('all')
+  return rc, rc.bbox('all')
 
-  W = int((x1 - x0 + 2*styles.padding) * scale)
-  H = int((y1 - y0 + 2*styles.padding) * scale)
+
+def layout_railroad(spec, title, url_map, styles, text_bbox=cairo_text_bbox, limits=None,
+    subtree_cache=None):
+  '''Lay out a diagram and prepare its shapes for drawing
+
+  text_bbox is the function used to measure text. Returns the RailCanvas
+  holding the shapes and the bounding box of the diagram before any padding
+  is added. All layout state belongs to the new canvas so this is safe to
+  call from multiple threads. limits is an optional RenderLimits.
+  subtree_cache is an optional IncrementalLayout.
+  '''
+  rc, bbox = layout_diagram(spec, title, url_map, styles, text_bbox, limits, subtree_cache)
 
   if not styles.arrows: # Remove arrow heads
     for s in rc.shapes:
       if 'arrow' in s.options:
         del s.options['arrow']
 
+  # Combine chains of connecting lines and arcs into paths
+  rc.shapes = merge_connectors(rc.shapes)
+
   if styles.shadow: # Draw shadows first
     bubs = [copy.deepcopy(s) for s in rc.shapes
       if isinstance(s, BoxBubbleShape) or isinstance(s, BubbleShape) or isinstance(s, HexBubbleShape)]
@@ -1795,85 +2847,955 @@ def render_railroad(spec, title, url_map, out_file, backend, styles, scale, tran
     bubs.extend(rc.shapes)
     rc.shapes = bubs
 
+  return rc, bbox
 
-  if backend == 'svg':
 
-    # Reposition all shapes in the viewport
-    for s in rc.shapes:
-      s.move(-x0 + styles.padding, -y0 + styles.padding)
+def spec_key(spec):
+  '''Convert a spec into a hashable form'''
+  if is_listy(spec):
+    return tuple(spec_key(s) for s in spec)
+  if isinstance(spec, Terminal): # Drawn differently from the same plain text
+    return (Terminal, spec)
+  return spec
 
-    # Generate CSS for fonts
-    text_color = rgb_to_hex(styles.text_color)
-    css = []
+class IncrementalLayout(object):
+  '''Lay out successive edits of a spec, reusing the unchanged parts
+
+  The shapes and exit point of every subtree drawn by the last layout are
+  kept. Subtrees that are unchanged in the next spec are copied from the
+  cache instead of being laid out and measured again, so only the edited
+  elements and the placement of their ancestors is recomputed. Subtrees
+  that are no longer in the spec are dropped after each layout.
+
+  The styles and url_map must not change between layouts.
+  '''
+  def __init__(self, styles, url_map=None, text_bbox=cairo_text_bbox, limits=None):
+    self.styles = styles
+    self.url_map = url_map
+    self.text_bbox = text_bbox
+    self.limits = limits
+    self.subtrees = {}
+    self.used = {}
+
+  def layout(self, spec, title=None):
+    '''Lay out a new version of the spec like layout_railroad()'''
+    self.used = {}
+    rc, bbox = layout_railroad(spec, title, self.url_map, self.styles, self.text_bbox, self.limits, self)
+
+    # Keep only the subtrees in this spec
+    self.subtrees = self.used
+    self.used = {}
+    return rc, bbox
+
+  def draw_cached(self, layout, spec, ltor):
+    '''Draw a spec element with a RailroadLayout or copy it from the cache'''
+    key = (spec_key(spec), ltor)
+    entry = self.used.get(key, None) or self.subtrees.get(key, None)
+    c = layout.canvas
+
+    if entry is None:
+      # The shapes of an element are the last ones on the canvas once it's drawn
+      start = len(c.shapes)
+      tag, exx, exy = layout.draw_element(spec, ltor)
+      shapes = [s.clone() for s in c.shapes[start:]]
+      for s in shapes:
+        s.dtag()
+      entry = (shapes, exx, exy)
+
+    else:
+      shapes, exx, exy = entry
+      tag = layout.get_tag()
+      shapes = [s.clone() for s in shapes]
+      for s in shapes:
+        s.addtag(tag)
+      c.shapes.extend(shapes)
 
-    fonts = {}
-    # Collect fonts from common styles
-    for f in [k for k in dir(styles) if k.endswith('_font')]:
-      fonts[f] = (getattr(styles, f), text_color)
-    # Collect node style fonts
-    for ns in styles.node_styles:
-      fonts[ns.name + '_font'] = (ns.font, rgb_to_hex(ns.text_color))
-
-    for f, fs in fonts.iteritems():
-      family, size, weight = fs[0]
-      text_color = fs[1]
-
-      if weight == 'italic':
-        style = 'italic'
-        weight = 'normal'
+    self.used[key] = entry
+    return [tag, exx, exy]
+
+
+def diagram_size(bbox, styles, scale=1.0):
+  '''Get the width and height of a drawn diagram including its padding'''
+  x0, y0, x1, y1 = bbox
+  W = int((x1 - x0 + 2*styles.padding) * scale)
+  H = int((y1 - y0 + 2*styles.padding) * scale)
+  return W, H
+
+def measure_railroad(spec, title, url_map, styles, scale=1.0, text_bbox=cairo_text_bbox, limits=None):
+  '''Find the size of a diagram without drawing it
+
+  Only the layout is run. Returns the (width, height) that the output image
+  would have at the given scale.
+  '''
+  rc, bbox = layout_diagram(spec, title, url_map, styles, text_bbox, limits)
+  return diagram_size(bbox, styles, scale)
+
+
+def split_sequence(spec):
+  '''Find the elements of the outermost line or stack of a spec
+
+  Returns (head, seq, elements, tail) where seq is the start of the sequence
+  with its type and any arguments before the elements. The head and tail are
+  lists of anything around the sequence such as the bullets added by
+  parse_spec(). None is returned if there is no sequence to split.
+  '''
+  head, tail = [], []
+  if is_listy(spec) and len(spec) == 4 and list(spec[0:2]) == ['line', 'bullet'] and spec[3] == 'bullet':
+    head, tail, spec = ['bullet'], ['bullet'], spec[2]
+
+  if not is_listy(spec) or len(spec) < 2:
+    return None
+
+  if spec[0] == 'line':
+    return head, ['line'], flatten_line(spec[1:]), tail
+  elif spec[0] in ('stack', 'rightstack'):
+    return head, [spec[0]], list(spec[1:]), tail
+  elif spec[0] == 'indentstack':
+    return head, list(spec[:2]), list(spec[2:]), tail
+
+  return None
+
+def split_railroad(spec, title, url_map, styles, max_pixels, scale=1.0, text_bbox=cairo_text_bbox,
+    limits=None, part_url=None):
+  '''Split a diagram that is too large into parts
+
+  The elements of the outermost line or stack are divided into runs that
+  fit within max_pixels at the given scale. Each part ends with a box
+  leading to the next part and the next one starts with a box coming from
+  the previous. If part_url is a format string these boxes link to the URL
+  for the part number. Parts are numbered from 1. An element that is too
+  large by itself gets a part of its own. Every part fits and would not fit
+  with the next element added. The split points are found by a search that
+  is only sure to find the longest run that fits when a longer run never has
+  a smaller area. This holds for lines. A stack can get narrower when a
+  shorter row ends it, so a part of a stack may stop before a longer run
+  that would also fit.
+
+  Returns a list of (spec, title, url_map) for the parts.
+  '''
+  split = split_sequence(spec)
+  if split is None:
+    return [(spec, title, url_map)]
+
+  head, seq, elements, tail = split
+  n = len(elements)
+  part_map = dict(url_map)
+
+  def part_spec(num, first, last):
+    start = head if first == 0 else ['/from part {}'.format(num - 1)]
+    end = tail if last == n else ['/to part {}'.format(num + 1)]
+    return ['line'] + start + [seq + elements[first:last]] + end
+
+  def part_title(num):
+    return None if title is None else '{} (part {})'.format(title, num)
+
+  # The parts share their elements with the whole diagram so their layouts are reused
+  incr = IncrementalLayout(styles, part_map, text_bbox, limits)
+
+  rc, bbox = incr.layout(spec, title)
+  W, H = diagram_size(bbox, styles, scale)
+  if W * H <= max_pixels:
+    return [(spec, title, url_map)]
+
+  def fits(num, first, last):
+    rc, bbox = incr.layout(part_spec(num, first, last), part_title(num))
+    W, H = diagram_size(bbox, styles, scale)
+    return W * H <= max_pixels
+
+  parts = []
+  first = 0
+  # Start by assuming the area grows in proportion to the number of elements.
+  # Later parts start from the length of the one before.
+  guess = max(1, int(n * max_pixels // (W * H)))
+  while first < n:
+    num = len(parts) + 1
+    if part_url is not None:
+      part_map['from part {}'.format(num)] = part_url.format(num)
+      part_map['to part {}'.format(num + 1)] = part_url.format(num + 1)
+
+    # Double the run from the guess until it doesn't fit then bisect for the
+    # longest run that does. Each part takes a logarithmic number of layouts.
+    last, over = first + 1, None
+    probe = min(max(first + guess, last + 1), n)
+    while over is None and last < n:
+      if fits(num, first, probe):
+        last = probe
+        probe = min(2 * last - first, n)
       else:
-        style = 'normal'
+        over = probe
 
-      css.append('''.{} {{fill:{}; text-anchor:middle;
+    while over is not None and over - last > 1:
+      mid = (last + over) // 2
+      if fits(num, first, mid):
+        last = mid
+      else:
+        over = mid
+
+    parts.append((part_spec(num, first, last), part_title(num), part_map))
+    guess = last - first
+    first = last
+
+  return parts
+
+
+class ShapeIndex(object):
+  '''Grid of shape bounding boxes for finding the shapes in part of an image
+
+  Shapes are indexed in image pixels using the bbox from layout_railroad()
+  with the styles and scale they will be drawn with. Each shape is listed in
+  every grid cell its bounding box touches so a query only checks the shapes
+  in the cells it covers. Build the index before the canvas is drawn since
+  the SVG backend moves the shapes.
+  '''
+  def __init__(self, rc, bbox, styles, scale=1.0, cell_size=128):
+    self.shapes = rc.shapes
+    self.origin = (bbox[0] - styles.padding, bbox[1] - styles.padding)
+    self.scale = scale
+    self.cell_size = cell_size
+    # Strokes and arrow heads extend past the bounding boxes
+    self.margin = 3 * max(styles.line_width, styles.outline_width) * scale
+
+    self.boxes = []
+    self.cells = {}
+    for i, shape in enumerate(self.shapes):
+      x0, y0, x1, y1 = shape.bbox
+      box = self.to_image(x0, y0) + self.to_image(x1, y1)
+      self.boxes.append(box)
+      for cell in self.cells_in(box, self.margin):
+        self.cells.setdefault(cell, []).append(i)
+
+    # Area of the image covered by cells
+    self.extent = None
+    if len(self.cells) > 0:
+      cols = [c for c, r in self.cells]
+      rows = [r for c, r in self.cells]
+      self.extent = (min(cols) * cell_size, min(rows) * cell_size, (max(cols) + 1) * cell_size,
+        (max(rows) + 1) * cell_size)
+
+  def to_image(self, x, y):
+    '''Convert canvas coordinates to image pixels'''
+    return ((x - self.origin[0]) * self.scale, (y - self.origin[1]) * self.scale)
+
+  def cells_in(self, box, margin=0):
+    cs = self.cell_size
+    x0, y0, x1, y1 = box
+    cols = range(int(math.floor((x0 - margin) / cs)), int(math.floor((x1 + margin) / cs)) + 1)
+    rows = range(int(math.floor((y0 - margin) / cs)), int(math.floor((y1 + margin) / cs)) + 1)
+    return [(c, r) for c in cols for r in rows]
+
+  def query(self, x0, y0, x1, y1):
+    '''Find the shapes that could be drawn in a rectangle of the image
+
+    Returns a list of indices into the shapes in drawing order.
+    '''
+    if self.extent is None:
+      return []
+
+    # Only visit cells that can hold shapes
+    ex0, ey0, ex1, ey1 = self.extent
+    x0, y0, x1, y1 = max(x0, ex0), max(y0, ey0), min(x1, ex1), min(y1, ey1)
+
+    m = self.margin
+    found = set()
+    for cell in self.cells_in((x0, y0, x1, y1)):
+      for i in self.cells.get(cell, ()):
+        bx0, by0, bx1, by1 = self.boxes[i]
+        if bx0 - m <= x1 and x0 <= bx1 + m and by0 - m <= y1 and y0 <= by1 + m:
+          found.add(i)
+    return sorted(found)
+
+  def region(self, x0, y0, x1, y1):
+    '''Get the shapes that could be drawn in a rectangle of the image'''
+    return [self.shapes[i] for i in self.query(x0, y0, x1, y1)]
+
+  def node_at(self, x, y):
+    '''Find the node drawn at a point of the image
+
+    Returns (text, href) for the topmost shape with text that contains the
+    point or None if there isn't one. href is None for nodes without a link.
+    '''
+    for i in reversed(self.query(x, y, x, y)):
+      text = self.shapes[i].options.get('text', None)
+      bx0, by0, bx1, by1 = self.boxes[i]
+      if text is not None and bx0 <= x <= bx1 and by0 <= y <= by1:
+        return (text, self.shapes[i].options.get('href', None))
+    return None
+
+  def links(self):
+    '''Get the (box, text, href) of every node with a link'''
+    return [(self.boxes[i], s.options['text'], s.options['href']) for i, s in enumerate(self.shapes)
+      if s.options.get('text', None) is not None and s.options.get('href', None) is not None]
+
+
+def crop_canvas(rc, bbox, styles, region, scale=1.0, index=None):
+  '''Select the shapes drawn in a region of a diagram
+
+  region is (x0, y0, x1, y1) in image pixels at the given scale. Returns a
+  new RailCanvas with copies of the shapes in the region and a bbox that
+  render_canvas() draws as an image of just that region. index is an
+  optional ShapeIndex of rc to reuse when cropping many regions.
+  '''
+  if index is None:
+    index = ShapeIndex(rc, bbox, styles, scale)
+
+  crop = RailCanvas(rc.text_bbox)
+  crop.shapes = [s.clone() for s in index.region(*region)]
+
+  # Place the region at the origin of the image after padding is added
+  x0, y0, x1, y1 = region
+  cx0 = index.origin[0] + x0 / float(scale) + styles.padding
+  cy0 = index.origin[1] + y0 / float(scale) + styles.padding
+  cx1 = cx0 + (x1 - x0) / float(scale) - 2*styles.padding
+  cy1 = cy0 + (y1 - y0) / float(scale) - 2*styles.padding
+
+  return crop, (cx0, cy0, cx1, cy1)
+
+
+def html_image_map(index, name):
+  '''Make an HTML image map for the linked nodes in a ShapeIndex'''
+  lines = [u'<map name="{}">'.format(xml_escape(name))]
+  for box, text, href in index.links():
+    coords = ','.join(str(int(round(v))) for v in box)
+    lines.append(u'  <area shape="rect" coords="{}" href="{}" alt="{}"/>'.format(coords,
+      xml_escape(href), xml_escape(text)))
+  lines.append(u'</map>\n')
+
+  return u'\n'.join(lines)
+
+
+def style_fonts(styles):
+  '''Collect the named fonts used by text shapes
+
+  Returns a dict of font_name -> (family, size, weight, style, hex color)
+  '''
+  text_color = rgb_to_hex(styles.text_color)
+
+  fonts = {}
+  # Collect fonts from common styles
+  for f in [k for k in dir(styles) if k.endswith('_font')]:
+    fonts[f] = (getattr(styles, f), text_color)
+  # Collect node style fonts
+  for ns in styles.node_styles:
+    fonts[ns.name + '_font'] = (ns.font, rgb_to_hex(ns.text_color))
+
+  for f, fs in fonts.items():
+    family, size, weight = fs[0]
+
+    if weight == 'italic':
+      style = 'italic'
+      weight = 'normal'
+    else:
+      style = 'normal'
+
+    fonts[f] = (family, size, weight, style, fs[1])
+
+  return fonts
+
+def svg_font_css(styles):
+  '''Generate CSS for fonts'''
+  css = []
+
+  for f, fs in style_fonts(styles).iteritems():
+    family, size, weight, style, text_color = fs
+
+    css.append('''.{} {{fill:{}; text-anchor:middle;
     font-family:{}; font-size:{}pt; font-weight:{}; font-style:{};}}'''.format(f,
       text_color, family, size, weight, style))
 
+  return css
 
-    font_styles = '\n'.join(css)
-    line_color = rgb_to_hex(styles.line_color)
+def svg_document(W, H, body, styles, fmt, transparent):
+  '''Wrap drawn shapes with the SVG header'''
+  css = svg_font_css(styles)
+  if fmt.compact:
+    css.append(fmt.css())
 
+  font_styles = '\n'.join(css)
+  line_color = rgb_to_hex(styles.line_color)
+
+  svg = [fmt.minify(svg_header.format(W,H, font_styles, line_color))]
+  if not transparent:
+    svg.append(u'<rect width="100%" height="100%" fill="white"/>')
+  svg.append(body)
+  svg.append(u'</svg>')
+  return u''.join(svg)
+
+def write_svg(out_file, svg):
+  if os.path.splitext(out_file)[1].lower() == '.svgz':
+    with gzip.open(out_file, 'wb') as fh:
+      fh.write(svg.encode('utf-8'))
+  else:
     with io.open(out_file, 'w', encoding='utf-8') as fh:
-      fh.write(svg_header.format(W,H, font_styles, line_color))
-      if not transparent:
-        fh.write(u'<rect width="100%" height="100%" fill="white"/>')
-      for s in rc.shapes:
-        svg_draw_shape(s, fh, styles)
-      fh.write(u'</svg>')
+      fh.write(svg)
 
-  else: # Cairo backend
-    ext = os.path.splitext(out_file)[1].lower()
 
-    if ext == '.svg':
-      surf = cairo.SVGSurface(out_file, W, H)
-    elif ext == '.pdf':
-      surf = cairo.PDFSurface(out_file, W, H)
-    elif ext in ('.ps', '.eps'):
-      surf = cairo.PSSurface(out_file, W, H)
-      if ext == '.eps':
+def cairo_draw_canvas(rc, bbox, ctx, W, H, styles, scale, transparent):
+  '''Draw the shapes from layout_railroad() onto a cairo context'''
+  x0, y0 = bbox[:2]
+  ctx.save()
+
+  if not transparent:
+    # Fill background
+    ctx.rectangle(0,0, W,H)
+    ctx.set_source_rgba(1.0,1.0,1.0)
+    ctx.fill()
+
+  ctx.scale(scale, scale)
+  ctx.translate(-x0 + styles.padding, -y0 + styles.padding)
+
+  cairo_draw_shapes(rc.shapes, ctx, styles)
+  ctx.restore()
+
+
+def render_railroad(spec, title, url_map, out_file, backend, styles, scale, transparent,
+    compact=False, precision=2, dedup=False, text_bbox=cairo_text_bbox, limits=None):
+  print('Rendering to {} using {} backend'.format(out_file, backend))
+
+  rc, bbox = layout_railroad(spec, title, url_map, styles, text_bbox, limits)
+  render_canvas(rc, bbox, out_file, backend, styles, scale, transparent, compact, precision, dedup,
+    limits)
+
+
+def format_backend(fmt):
+  '''Get the backend used to draw an output format given by its extension'''
+  if fmt in ('svg', 'svgz'):
+    return 'svg'
+  elif fmt == 'json':
+    return 'json'
+  return 'cairo'
+
+def draw_canvas(rc, bbox, fmt, backend, styles, scale, transparent,
+    compact=False, precision=2, dedup=False, limits=None):
+  '''Draw the shapes from layout_railroad() for an output format
+
+  fmt is the extension of the output format without the dot. Returns a
+  drawing to be converted into the output by encode_drawing(). The size of
+  bitmaps is checked against limits before they are allocated.
+  '''
+  x0, y0, x1, y1 = bbox
+  W, H = diagram_size(bbox, styles, scale)
+
+  if backend == 'svg':
+
+    # Reposition all shapes in the viewport
+    for s in rc.shapes:
+      s.move(-x0 + styles.padding, -y0 + styles.padding)
+
+    svg_fmt = SvgFormat(compact, precision, dedup)
+
+    # Shapes are drawn first so that any classes they need are known for the header
+    body = io.StringIO()
+    svg_draw_shapes(rc.shapes, body, styles, svg_fmt)
+
+    return svg_document(W, H, body.getvalue(), styles, svg_fmt, transparent)
+
+  elif backend == 'json':
+
+    # Reposition all shapes in the viewport
+    for s in rc.shapes:
+      s.move(-x0 + styles.padding, -y0 + styles.padding)
+
+    geometry = json_draw_shapes(rc.shapes, styles, precision)
+    geometry['width'] = W
+    geometry['height'] = H
+    geometry['scale'] = scale
+    if not transparent:
+      geometry['background'] = '#ffffff'
+
+    return geometry
+
+  else: # Cairo backend
+    cairo = load_backend('cairo')
+    buf = io.BytesIO()
+
+    if fmt == 'svg':
+      surf = cairo.SVGSurface(buf, W, H)
+    elif fmt == 'pdf':
+      surf = cairo.PDFSurface(buf, W, H)
+    elif fmt in ('ps', 'eps'):
+      surf = cairo.PSSurface(buf, W, H)
+      if fmt == 'eps':
         surf.set_eps(True)
     else: # Bitmap
+      if limits is not None:
+        limits.check_size(W, H)
       surf = cairo.ImageSurface(cairo.FORMAT_ARGB32, W, H)
 
     ctx = cairo.Context(surf)
+    cairo_draw_canvas(rc, (x0,y0,x1,y1), ctx, W, H, styles, scale, transparent)
 
-    if not transparent:
-      # Fill background
-      ctx.rectangle(0,0, W,H)
-      ctx.set_source_rgba(1.0,1.0,1.0)
-      ctx.fill()
+    return (surf, buf)
 
-    ctx.scale(scale, scale)
-    ctx.translate(-x0 + styles.padding, -y0 + styles.padding)
+def encode_drawing(drawing, fmt, backend):
+  '''Convert a drawing from draw_canvas() into the bytes of an output file'''
+  if backend == 'svg':
+    data = drawing.encode('utf-8')
+    if fmt == 'svgz':
+      buf = io.BytesIO()
+      with gzip.GzipFile(fileobj=buf, mode='wb') as fh:
+        fh.write(data)
+      data = buf.getvalue()
+    return data
 
-    for s in rc.shapes:
-      cairo_draw_shape(s, ctx, styles)
+  elif backend == 'json':
+    return json.dumps(drawing, separators=(',',':'), sort_keys=True).encode('utf-8')
 
-    if ext in ('.svg', '.pdf', '.ps', '.eps'):
+  else: # Cairo backend
+    surf, buf = drawing
+    if fmt in ('svg', 'pdf', 'ps', 'eps'):
       surf.show_page()
+      surf.finish()
     else:
-      surf.write_to_png(out_file)
+      surf.write_to_png(buf)
+    return buf.getvalue()
+
+def render_canvas(rc, bbox, out_file, backend, styles, scale, transparent,
+    compact=False, precision=2, dedup=False, limits=None, fmt=None):
+  '''Draw the shapes from layout_railroad() to an output file
+
+  out_file can also be a binary file object. The format is taken from the
+  extension of the file name unless fmt is given.
+  '''
+  if fmt is None:
+    fmt = os.path.splitext(out_file)[1][1:].lower()
+  drawing = draw_canvas(rc, bbox, fmt, backend, styles, scale, transparent, compact, precision, dedup,
+    limits)
+
+  if hasattr(out_file, 'write'):
+    out_file.write(encode_drawing(drawing, fmt, backend))
+  else:
+    with open(out_file, 'wb') as fh:
+      fh.write(encode_drawing(drawing, fmt, backend))
+
+
+class RenderSession(object):
+  '''Holds the state for a series of renders in a long running process
+
+  Each layout gets a fresh canvas so tag counters and text ids always start
+  over. The canvas from the last layout is kept until the next one or until
+  release() is called. Text measurements are cached to speed up repeated
+  renders with the same fonts. The cache is emptied once it reaches
+  cache_size entries so memory use stays bounded. Every render is checked
+  against the optional RenderLimits.
+
+  A session isn't thread safe. Use one per thread.
+  '''
+  def __init__(self, styles, text_bbox=cairo_text_bbox, cache_size=4096, limits=None):
+    self.styles = styles
+    self.measure = text_bbox
+    self.cache_size = cache_size
+    self.limits = limits
+    self.text_sizes = {}
+    self.canvas = None
+
+  def text_bbox(self, text, font_params, scale=1.0):
+    '''Cached text measurement passed to each RailCanvas'''
+    key = (text, tuple(font_params), scale)
+    bbox = self.text_sizes.get(key, None)
+    if bbox is None:
+      if len(self.text_sizes) >= self.cache_size:
+        self.text_sizes.clear()
+      bbox = self.measure(text, font_params, scale)
+      self.text_sizes[key] = bbox
+    return list(bbox)
+
+  def layout(self, spec, title=None, url_map=None):
+    '''Lay out a diagram on a new canvas'''
+    self.release()
+    self.canvas, bbox = layout_railroad(spec, title, url_map, self.styles, self.text_bbox, self.limits)
+    return self.canvas, bbox
+
+  def render(self, spec, title, url_map, out_file, backend='svg', scale=1.0, transparent=False,
+      compact=False, precision=2, dedup=False):
+    '''Lay out and draw a diagram, releasing its shapes afterward'''
+    rc, bbox = self.layout(spec, title, url_map)
+    try:
+      render_canvas(rc, bbox, out_file, backend, self.styles, scale, transparent, compact, precision, dedup,
+        self.limits)
+    finally:
+      self.release()
+
+  def release(self):
+    '''Drop the shapes from the last layout'''
+    if self.canvas is not None:
+      del self.canvas.shapes[:]
+      self.canvas = None
+
+  def close(self):
+    '''Release all state held by the session'''
+    self.release()
+    self.text_sizes.clear()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+
+# Maximum number of diagrams rendered at once by the default render_async() pool
+async_max_workers = 4
+_async_executor = None
+
+class RenderCancelled(Exception):
+  '''The render behind a RenderFuture was cancelled'''
+  pass
+
+class RenderFuture(object):
+  '''The pending result of a render started by render_async()
+
+  result() waits for the bytes of the output from any thread. On Python 3
+  the future can also be awaited in an asyncio coroutine. Cancelling it
+  stops the render before its next phase starts.
+  '''
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._finished = threading.Event()
+    self._state = 'pending'
+    self._value = None
+    self._callbacks = []
+
+  def _finish(self, state, value):
+    with self._lock:
+      if self._finished.is_set():
+        return False
+      self._state = state
+      self._value = value
+      self._finished.set()
+      callbacks, self._callbacks = self._callbacks, []
+
+    for fn in callbacks:
+      fn(self)
+    return True
+
+  def cancel(self):
+    '''Stop the render if it hasn't finished. Returns True if it was cancelled.'''
+    return self._finish('cancelled', None)
+
+  def cancelled(self):
+    return self._state == 'cancelled'
+
+  def done(self):
+    return self._finished.is_set()
+
+  def result(self, timeout=None):
+    '''Wait for the render and return the bytes of the output
+
+    RenderCancelled is raised if the render was cancelled and any error from
+    the render is raised again here.
+    '''
+    if not self._finished.wait(timeout):
+      raise RuntimeError('Render did not finish within {} seconds'.format(timeout))
+    if self._state == 'cancelled':
+      raise RenderCancelled('Render was cancelled')
+    if self._state == 'error':
+      raise self._value
+    return self._value
+
+  def add_done_callback(self, fn):
+    '''Call fn with this future once it is finished or cancelled'''
+    with self._lock:
+      if not self._finished.is_set():
+        self._callbacks.append(fn)
+        return
+    fn(self)
+
+  def __await__(self):
+    import asyncio
+    loop = asyncio.get_event_loop()
+    waiter = loop.create_future()
+
+    def copy_result(f):
+      if waiter.done():
+        return
+      if f._state == 'cancelled':
+        waiter.cancel()
+      elif f._state == 'error':
+        waiter.set_exception(f._value)
+      else:
+        waiter.set_result(f._value)
+
+    def cancel_render(w): # The awaiting task was cancelled
+      if w.cancelled():
+        self.cancel()
+
+    waiter.add_done_callback(cancel_render)
+    self.add_done_callback(lambda f: loop.call_soon_threadsafe(copy_result, f))
+    return waiter.__await__()
 
 
+class RenderPool(object):
+  '''A fixed number of worker threads that run render_async() jobs
+
+  Threads are started as jobs arrive up to max_workers. Jobs wait in a queue
+  until a worker is free so this bounds how many diagrams render at once.
+  '''
+  def __init__(self, max_workers=4):
+    self.max_workers = max_workers
+    self.jobs = Queue.Queue()
+    self.threads = []
+    self.lock = threading.Lock()
+
+  def submit(self, fn, *args):
+    with self.lock:
+      if len(self.threads) < self.max_workers:
+        t = threading.Thread(target=self._work)
+        t.daemon = True
+        t.start()
+        self.threads.append(t)
+    self.jobs.put((fn, args))
+
+  def _work(self):
+    while True:
+      fn, args = self.jobs.get()
+      if fn is None: # Shut down
+        return
+      fn(*args)
+
+  def shutdown(self):
+    '''Stop the workers after the queued jobs are finished'''
+    with self.lock:
+      threads, self.threads = self.threads, []
+    for t in threads:
+      self.jobs.put((None, ()))
+    for t in threads:
+      t.join()
+
+def async_executor():
+  '''Get the shared RenderPool used by render_async()'''
+  global _async_executor
+  with _backend_lock:
+    if _async_executor is None:
+      _async_executor = RenderPool(async_max_workers)
+  return _async_executor
+
+def render_async(spec, styles, fmt='svg', title=None, url_map=None, scale=1.0, transparent=False,
+    text_bbox=cairo_text_bbox, limits=None, executor=None):
+  '''Render a diagram in the background
+
+  spec is a diagram spec or the text of a spec file. fmt is the extension of
+  the output format. The parse, layout, draw, and encode phases run in turn
+  on a worker of the executor. Cancelling the returned future stops the
+  render before the next phase starts. executor is anything with a
+  submit(fn) method such as a RenderPool or a concurrent.futures executor.
+  The number of concurrent renders is bounded by its workers. The default
+  pool has async_max_workers threads. limits is an optional RenderLimits
+  checked while parsing, layout, and drawing.
+
+  Returns a RenderFuture for the bytes of the output.
+  '''
+  if executor is None:
+    executor = async_executor()
+
+  backend = format_backend(fmt)
+
+  def parse(spec):
+    if isinstance(spec, basestring):
+      return parse_spec(spec, limits)
+    return spec, url_map
+
+  def layout(parsed):
+    spec, url_map = parsed
+    return layout_railroad(spec, title, url_map, styles, text_bbox, limits)
+
+  def draw(laid_out):
+    rc, bbox = laid_out
+    return draw_canvas(rc, bbox, fmt, backend, styles, scale, transparent, limits=limits)
+
+  def encode(drawing):
+    return encode_drawing(drawing, fmt, backend)
+
+  future = RenderFuture()
+
+  def run():
+    value = spec
+    for phase in (parse, layout, draw, encode):
+      if future.done(): # Cancelled
+        return
+      try:
+        value = phase(value)
+      except Exception as e:
+        future._finish('error', e)
+        return
+    future._finish('done', value)
+
+  executor.submit(run)
+  return future
+
+
+def render_svg_sprites(diagrams, out_file, styles, transparent, compact=False, precision=2, dedup=False,
+    text_bbox=cairo_text_bbox, limits=None):
+  '''Render several diagrams into a single SVG sprite sheet
+
+  diagrams is a sequence of (name, spec, title, url_map) tuples. Each diagram
+  becomes a <symbol> with its name as the id and its own viewBox. A name
+  used more than once gets a numeric suffix so every id is unique. The font
+  styles and arrow marker are shared by all of them.
+  '''
+  print('Rendering {} diagrams to {} sprite sheet'.format(len(diagrams), out_file))
+
+  fmt = SvgFormat(compact, precision, dedup)
+  body = io.StringIO()
+  used = set()
+
+  for name, spec, title, url_map in diagrams:
+    if name in used: # Same file name in different directories
+      i = 2
+      while '{}-{}'.format(name, i) in used:
+        i += 1
+      name = '{}-{}'.format(name, i)
+      print('  Duplicate symbol id renamed to "{}"'.format(name))
+    used.add(name)
+
+    rc, (x0,y0,x1,y1) = layout_railroad(spec, title, url_map, styles, text_bbox, limits)
+    W, H = diagram_size((x0,y0,x1,y1), styles)
+
+    for s in rc.shapes:
+      s.move(-x0 + styles.padding, -y0 + styles.padding)
+
+    fmt.id_prefix = name + '-' # Keep shared node ids distinct between diagrams
+    body.write(fmt.line(u'<symbol id="{}" viewBox="0 0 {} {}">'.format(name, W, H)))
+    if not transparent:
+      body.write(fmt.line(u'<rect width="100%" height="100%" fill="white"/>'))
+    svg_draw_shapes(rc.shapes, body, styles, fmt)
+    body.write(fmt.line(u'</symbol>'))
+
+  # The sheet itself has no visible content
+  write_svg(out_file, svg_document(0, 0, body.getvalue(), styles, fmt, True))
+
+
+def render_pdf_pages(diagrams, out_file, styles, scale, transparent, limits=None):
+  '''Render several diagrams into a multi-page PDF
+
+  diagrams is a sequence of (name, spec, title, url_map) tuples. Each diagram
+  is drawn on its own page sized to fit it. If the installed cairo supports
+  it, an outline entry links to each page.
+  '''
+  print('Rendering {} diagrams to {} pages'.format(len(diagrams), out_file))
+  cairo = load_backend('cairo')
+
+  surf = None
+  for page, (name, spec, title, url_map) in enumerate(diagrams, 1):
+    rc, bbox = layout_railroad(spec, title, url_map, styles, limits=limits)
+    W, H = diagram_size(bbox, styles, scale)
+
+    if surf is None:
+      surf = cairo.PDFSurface(out_file, W, H)
+      ctx = cairo.Context(surf)
+    else:
+      surf.set_size(W, H)
+
+    cairo_draw_canvas(rc, bbox, ctx, W, H, styles, scale, transparent)
+
+    if hasattr(surf, 'add_outline'): # Requires cairo 1.16
+      surf.add_outline(cairo.PDF_OUTLINE_ROOT, title if title is not None else name,
+        'page={}'.format(page), 0)
+
+    ctx.show_page()
+
+  if surf is not None:
+    surf.finish()
+
+# Shape classes by their name in a display list
+display_shape_kinds = {
+  'line': LineShape,
+  'rect': RectShape,
+  'oval': OvalShape,
+  'arc': ArcShape,
+  'text': TextShape,
+  'bubble': BubbleShape,
+  'boxbubble': BoxBubbleShape,
+  'hexbubble': HexBubbleShape,
+  'path': PathShape
+}
+
+# Shape options that are stored in the shared style table of a display list
+display_style_keys = ('width', 'fill', 'font', 'font_name', 'text_color', 'style', 'anchor')
+
+display_list_version = 1
+
+def save_display_list(rc, bbox, styles, fname):
+  '''Save the shapes from layout_railroad() so they can be drawn later
+
+  The display list is JSON holding the diagram bounding box, the drawing
+  styles, a table of shared shape styles, and one entry per shape with its
+  kind, style index, points, and any remaining options.
+  '''
+  kinds = dict((cls, k) for k, cls in display_shape_kinds.iteritems())
+
+  style_table = []
+  style_index = {}
+  shapes = []
+  for s in rc.shapes:
+    opts = dict(s.options)
+    style = dict((k, opts.pop(k)) for k in display_style_keys if k in opts)
+    key = json.dumps(style, sort_keys=True)
+    if key not in style_index:
+      style_index[key] = len(style_table)
+      style_table.append(style)
+
+    if isinstance(s, PathShape):
+      opts['segments'] = s.segments
+
+    entry = [kinds[type(s)], style_index[key], list(s.points)]
+    if len(opts) > 0:
+      entry.append(opts)
+    shapes.append(entry)
+
+  draw_style = dict((k, v) for k, v in vars(styles).iteritems() if k != 'node_styles')
+  # Text is already transformed so text_mod isn't needed to draw the shapes
+  node_styles = [(ns.name, dict((k, v) for k, v in vars(ns).iteritems() \
+    if k not in ('name', 'text_mod', 'text_mod_func'))) for ns in styles.node_styles]
+
+  dl = {
+    'version': display_list_version,
+    'bbox': list(bbox),
+    'style': draw_style,
+    'node_styles': node_styles,
+    'shape_styles': style_table,
+    'shapes': shapes
+  }
+
+  with io.open(fname, 'w', encoding='utf-8') as fh:
+    fh.write(unicode(json.dumps(dl, separators=(',',':'))))
+
+def load_display_list(fname):
+  '''Load a display list saved by save_display_list()
+
+  Returns a RailCanvas holding the shapes, the bounding box, and the DrawStyle.
+  '''
+  with io.open(fname, 'r', encoding='utf-8') as fh:
+    dl = json.load(fh)
+
+  if dl.get('version', None) != display_list_version:
+    raise ValueError('Unsupported display list version in "{}"'.format(fname))
+
+  # Never evaluate a text_mod from the file. The saved text was already transformed.
+  node_styles = [(name, dict((k, v) for k, v in ns.iteritems() if k != 'text_mod')) \
+    for name, ns in dl['node_styles']]
+  styles = DrawStyle(dl['style'], node_styles)
+
+  rc = RailCanvas()
+  for entry in dl['shapes']:
+    kind, style, points = entry[:3]
+    options = dict(dl['shape_styles'][style])
+    if len(entry) > 3:
+      options.update(entry[3])
+
+    cls = display_shape_kinds[kind]
+    if cls is PathShape:
+      options.pop('arrows', None) # Saved by earlier versions
+      shape = PathShape(options.pop('segments'), points, options)
+    elif cls is TextShape: # Text was already measured
+      shape = TextShape.__new__(TextShape)
+      BaseShape.__init__(shape)
+      shape.options = options
+      shape._bbox = list(points)
+    else:
+      shape = cls(points[0], points[1], points[2], points[3], options)
+    rc.shapes.append(shape)
+
+  return rc, tuple(dl['bbox']), styles
 
 def line(*args):
   return ['line'] + list(args)
@@ -1887,6 +3809,16 @@ def toploop(fwd, back):
 def choice(*args):
   return ['or'] + list(args)
 
+def flatten_line(lx):
+  '''Splice the elements of any nested lines into a line'''
+  terms = []
+  for term in lx:
+    if is_listy(term) and len(term) > 1 and term[0] == 'line':
+      terms.extend(flatten_line(term[1:]))
+    else:
+      terms.append(term)
+  return terms
+
 def is_listy(v):
   return isinstance(v, collections.Sequence) and not isinstance(v, basestring)
 
@@ -1910,13 +3842,300 @@ def rightstack(*args):
 def indentstack(indent, *args):
   return ['indentstack', indent] + list(args)
 
+class Terminal(unicode):
+  '''Node text that is drawn exactly as written
+
+  A terminal is never a bullet or a link. Only node styles without a
+  text_mod are matched against it so a leading "/" doesn't make a box.
+  '''
+  pass
+
+
+ebnf_token_re = re.compile(r'''
+    (?P<space>\s+|/\*.*?\*/|\(\*.*?\*\))
+  | (?P<define>::=|=)
+  | (?P<string>"[^"]*"|'[^']*')
+  | (?P<charclass>\[\^?(?:\\.|[^\]\\])+\])
+  | (?P<hex>\#x[0-9a-fA-F]+)
+  | (?P<name>[A-Za-z_][\w.]*(?:-[A-Za-z_][\w.]*)*)
+  | (?P<op>[|?*+()\[\]{},;.-])
+  ''', re.VERBOSE | re.DOTALL)
+
+class EbnfParser(object):
+  '''Convert EBNF grammars into Syntrax specs
+
+  Both W3C style (name ::= ...) and ISO style (name = ... ;) productions
+  are supported. Sequences become line(), alternatives choice(), optional
+  items opt(), "+" repetition loop(), and "*" repetition optloop(). An item
+  followed by a starred group ending in the same item, like
+  item (',' item)*, becomes a loop with the separator on the return path.
+  Nonterminals are drawn as boxes and terminals as bubbles.
+  '''
+  def __init__(self, text):
+    # ISO style grammars use [] and {} for options and repetition
+    self.iso = re.search(r'::=', text) is None
+    self.text = text
+    self.tokens = []
+
+    pos = 0
+    line_num = 1
+    while pos < len(text):
+      m = ebnf_token_re.match(text, pos)
+      if m is None or (m.lastgroup == 'charclass' and self.iso):
+        m = re.compile(r'[\[\]]').match(text, pos) if self.iso else None
+        if m is None:
+          raise ValueError('Invalid EBNF on line {}: "{}"'.format(line_num, text[pos:pos+20].split('\n')[0]))
+        kind = 'op'
+      else:
+        kind = m.lastgroup
+
+      if kind != 'space':
+        self.tokens.append((kind, m.group(), line_num, m.start(), m.end()))
+      line_num += m.group().count('\n')
+      pos = m.end()
+
+    self.pos = 0
+
+  def peek(self, offset=0):
+    i = self.pos + offset
+    return self.tokens[i] if i < len(self.tokens) else (None, None, None, None, None)
+
+  def expect(self, kind, value=None):
+    tok = self.peek()
+    if tok[0] != kind or (value is not None and tok[1] != value):
+      raise ValueError('Expected "{}" on line {} but found "{}"'.format(value or kind, tok[2], tok[1]))
+    self.pos += 1
+    return tok
+
+  def productions(self):
+    '''Returns a list of (name, spec) for each production'''
+    prods = []
+    while self.peek()[0] is not None:
+      name = self.expect('name')[1]
+      self.expect('define')
+      prods.append((name, self.parse_choice()))
+
+      if self.iso:
+        if self.peek()[1] in (';', '.'):
+          self.pos += 1
+        else:
+          self.expect('op', ';')
+
+    return prods
+
+  def at_production(self):
+    # W3C productions end where the next "name ::=" begins
+    return self.peek()[0] == 'name' and self.peek(1)[0] == 'define'
+
+  def parse_choice(self):
+    alts = [self.parse_sequence()]
+    while self.peek()[1] == '|':
+      self.pos += 1
+      alts.append(self.parse_sequence())
+
+    if len(alts) == 1:
+      return alts[0]
+
+    if None in alts: # Empty alternative
+      alts = [a for a in alts if a is not None]
+      return opt(alts[0]) if len(alts) == 1 else opt(choice(*alts))
+    return choice(*alts)
+
+  def parse_sequence(self):
+    items = []
+    while True:
+      kind, value = self.peek()[:2]
+      if kind is None or self.at_production() or value in ('|', ')', ']', '}', ';') or \
+        (self.iso and value == '.'):
+        break
+      if value == ',': # ISO concatenation
+        self.pos += 1
+        continue
+
+      item = self.parse_term()
+
+      # Turn "item (sep item)*" into a loop with the separator on the return path
+      if len(items) > 0 and is_listy(item) and item[0] == 'optloop':
+        body = item[1]
+        if is_listy(body) and body[0] == 'line' and len(body) > 2 and body[-1] == items[-1]:
+          back = body[1:-1]
+          items[-1] = loop(items[-1], back[0] if len(back) == 1 else line(*back))
+          continue
+        elif body == items[-1]:
+          items[-1] = loop(items[-1], None)
+          continue
+
+      items.append(item)
+
+    if len(items) == 0:
+      return None
+    return items[0] if len(items) == 1 else line(*items)
+
+  def parse_term(self):
+    start = self.pos
+    item = self.parse_repeat(self.parse_primary())
+
+    if self.peek()[1] == '-': # Exclusion can't be drawn so show its text in a box
+      self.pos += 1
+      self.parse_repeat(self.parse_primary())
+      item = '/' + self.text[self.tokens[start][3]:self.tokens[self.pos-1][4]]
+
+    return item
+
+  def parse_repeat(self, item):
+    while self.peek()[1] in ('?', '*', '+'):
+      op = self.expect('op')[1]
+      if op == '?':
+        item = opt(item)
+      elif op == '*':
+        item = optloop(item, None)
+      else:
+        item = loop(item, None)
+
+    return item
+
+  def parse_primary(self):
+    kind, value, line_num = self.peek()[:3]
+    self.pos += 1
+
+    if kind == 'name':
+      return '/' + value # Nonterminals are boxes
+    elif kind == 'string':
+      return Terminal(value[1:-1])
+    elif kind in ('charclass', 'hex'):
+      return value
+    elif value == '(':
+      item = self.parse_choice()
+      self.expect('op', ')')
+      return item
+    elif self.iso and value == '[':
+      item = self.parse_choice()
+      self.expect('op', ']')
+      return None if item is None else opt(item)
+    elif self.iso and value == '{':
+      item = self.parse_choice()
+      self.expect('op', '}')
+      return None if item is None else optloop(item, None)
+
+    raise ValueError('Unexpected "{}" on line {}'.format(value, line_num))
+
+def parse_ebnf_file(fname):
+  '''Read the productions of an EBNF grammar
+
+  Returns a list of (name, spec) with start and end bullets added to each spec.
+  '''
+  with io.open(fname, 'r', encoding='utf-8') as fh:
+    prods = EbnfParser(fh.read()).productions()
+
+  return [(name, ['line', 'bullet', spec, 'bullet']) for name, spec in prods]
+
+def diagram_name(name):
+  '''Make a name safe to use for files and ids'''
+  return re.sub(r'[^\w.-]', '_', name)
+
+def ebnf_url_map(names, url_format):
+  '''Link each nonterminal to the diagram for its production'''
+  return dict((name, url_format.format(diagram_name(name))) for name in names)
+
 
 url_map_re = re.compile(r'^\s*url_map\s*=\s*')
 
-def parse_spec_file(fname):
+# Functions that can be called from a spec file
+spec_functions = dict((f.__name__, f) for f in (line, loop, toploop, choice, opt, optx, optloop,
+  stack, rightstack, indentstack))
+
+# Literal nodes differ between Python versions
+_ast_constant = getattr(ast, 'Constant', ()) # Python 3.8+
+_ast_name_constant = getattr(ast, 'NameConstant', ()) # Python 3.4 to 3.7
+_ast_str = getattr(ast, 'Str', ()) # Before Python 3.8
+_ast_num = getattr(ast, 'Num', ())
+
+def eval_spec(spec, limits=None):
+  '''Build a spec object from its text without running arbitrary code
+
+  Only calls to the functions in spec_functions, strings, numbers, lists,
+  and tuples are accepted. Elements and nesting depth are counted as the
+  text is walked and checked against the optional RenderLimits before any
+  more of the spec is built. SpecError is raised for anything else.
+  '''
+  try:
+    tree = ast.parse(spec.strip(), mode='eval')
+  except SyntaxError as e:
+    raise SpecError('Invalid spec: {}'.format(e))
+  except (MemoryError, RuntimeError): # Deep nesting can exhaust the parser
+    raise SpecError('Invalid spec: nested too deeply')
+
+  nodes = [0]
+
+  def fail(node, msg):
+    raise SpecError('Invalid spec on line {}: {}'.format(getattr(node, 'lineno', '?'), msg))
+
+  def build(node, depth):
+    nodes[0] += 1
+    if limits is not None:
+      limits.check_count(nodes[0], depth)
+
+    if isinstance(node, _ast_constant):
+      if node.value is None or isinstance(node.value, (basestring, int, long, float)):
+        return node.value
+      fail(node, 'unsupported constant {!r}'.format(node.value))
+
+    elif isinstance(node, _ast_str):
+      return node.s
+
+    elif isinstance(node, _ast_num) and not isinstance(node.n, complex):
+      return node.n
+
+    elif isinstance(node, ast.Name) and node.id in ('None', 'True', 'False'): # Python 2
+      return {'None': None, 'True': True, 'False': False}[node.id]
+
+    elif isinstance(node, _ast_name_constant):
+      return node.value
+
+    elif isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+      value = build(node.operand, depth + 1)
+      if not isinstance(value, (int, long, float)) or isinstance(value, bool):
+        fail(node, 'sign applied to a non-number')
+      return -value if isinstance(node.op, ast.USub) else value
+
+    elif isinstance(node, ast.List):
+      return [build(n, depth + 1) for n in node.elts]
+
+    elif isinstance(node, ast.Tuple):
+      return tuple(build(n, depth + 1) for n in node.elts)
+
+    elif isinstance(node, ast.Call):
+      if not isinstance(node.func, ast.Name) or node.func.id not in spec_functions:
+        fail(node, 'only calls to {} are allowed'.format(', '.join(sorted(spec_functions))))
+      if node.keywords or getattr(node, 'starargs', None) or getattr(node, 'kwargs', None):
+        fail(node, 'keyword and * arguments are not allowed in {}()'.format(node.func.id))
+
+      args = [build(n, depth + 1) for n in node.args]
+      try:
+        return spec_functions[node.func.id](*args)
+      except TypeError as e: # Wrong number of arguments
+        fail(node, e)
+
+    fail(node, '{} is not allowed'.format(type(node).__name__))
+
+  return build(tree.body, 1)
+
+
+def parse_spec_file(fname, limits=None):
   # Read input diagram
+  if fname == '-': # From stdin
+    with io.open(sys.stdin.fileno(), 'r', encoding='utf-8', closefd=False) as fh:
+      return parse_spec(fh.read(), limits)
+
   with io.open(fname, 'r', encoding='utf-8') as fh:
-    spec_lines = fh.readlines()
+    return parse_spec(fh.read(), limits)
+
+def parse_spec(spec_text, limits=None):
+  '''Parse the text of a spec file into a spec and url_map
+
+  limits is an optional RenderLimits checked while the spec is read.
+  '''
+  spec_lines = io.StringIO(spec_text).readlines()
 
   map_line = -1
   # Split off any url_map
@@ -1936,12 +4155,17 @@ def parse_spec_file(fname):
 
 
   # Parse the spec into an object
-  spec = eval(spec) # FIXME: Unsafe
+  spec = eval_spec(spec, limits)
 
   # Add start and end bullets
   spec = ['line', 'bullet', spec, 'bullet']
 
-  url_map = ast.literal_eval(url_map)
+  try:
+    url_map = ast.literal_eval(url_map.strip())
+  except (ValueError, SyntaxError, MemoryError, RuntimeError) as e:
+    raise SpecError('Invalid url_map on line {}: {}'.format(map_line + 1, e))
+  if not isinstance(url_map, dict):
+    raise SpecError('Invalid url_map on line {}: expected a dict'.format(map_line + 1))
 
   return spec, url_map
 
@@ -1959,7 +4183,8 @@ def dump_style_ini(ini_file):
     'text_color',
     'shadow',
     'shadow_fill',
-    'title_font')
+    'title_font',
+    'max_width')
 
   defaults = DrawStyle()
 
@@ -1978,11 +4203,57 @@ def parse_args():
   parser = argparse.ArgumentParser(description='Railroad diagram generator')
   parser.add_argument('-i', '--input', dest='input', action='store', help='Diagram spec file')
   parser.add_argument('-o', '--output', dest='output', action='store', help='Output file')
+  parser.add_argument('--format', dest='format', action='store',
+    choices=('png', 'svg', 'svgz', 'pdf', 'ps', 'eps', 'json'), help='Output format')
   parser.add_argument('-s', '--style', dest='styles', action='store', default='syntrax.ini', help='Style config file')
   parser.add_argument('--title', dest='title', action='store', help='Diagram title')
   parser.add_argument('-t', '--transparent', dest='transparent', action='store_true',
     default=False, help='Transparent background')
   parser.add_argument('--scale', dest='scale', action='store', default='1', help='Scale image')
+  parser.add_argument('--compact', dest='compact', action='store_true', default=False,
+    help='Minimize SVG output size')
+  parser.add_argument('--precision', dest='precision', action='store', type=int, default=2,
+    help='Decimal places for compact SVG and JSON coordinates')
+  parser.add_argument('--dedup', dest='dedup', action='store_true', default=False,
+    help='Share repeated SVG nodes as symbols')
+  parser.add_argument('--sprites', dest='sprites', action='store_true', default=False,
+    help='Render all inputs into one SVG sprite sheet')
+  parser.add_argument('--page-titles', dest='page_titles', action='store_true', default=False,
+    help='Title each page of a multi-page PDF with its file name')
+  parser.add_argument('--metrics', dest='metrics', action='store', choices=('pango', 'builtin'),
+    default='pango', help='Text measurement for SVG output')
+  parser.add_argument('--font-dir', dest='font_dirs', action='append', default=[],
+    help='Directory of font files for builtin metrics')
+  parser.add_argument('--watch', dest='watch', action='store_true', default=False,
+    help='Render inputs again when they change')
+  parser.add_argument('--measure', dest='measure', action='store_true', default=False,
+    help='Print diagram sizes without rendering')
+  parser.add_argument('--max-nodes', dest='max_nodes', action='store', type=int,
+    help='Maximum number of spec elements')
+  parser.add_argument('--max-depth', dest='max_depth', action='store', type=int,
+    help='Maximum spec nesting depth')
+  parser.add_argument('--max-shapes', dest='max_shapes', action='store', type=int,
+    help='Maximum number of shapes in a diagram')
+  parser.add_argument('--max-pixels', dest='max_pixels', action='store', type=int,
+    help='Maximum area of bitmap images')
+  parser.add_argument('--time-limit', dest='time_limit', action='store', type=float,
+    help='Maximum seconds for layout')
+  parser.add_argument('--max-width', dest='max_width', action='store', type=int,
+    help='Wrap long lines to fit this image width')
+  parser.add_argument('--split-pixels', dest='split_pixels', action='store', type=int,
+    help='Split larger diagrams into linked parts')
+  parser.add_argument('--region', dest='region', action='store', type=region_arg, metavar='X0,Y0,X1,Y1',
+    help='Render only this part of the image')
+  parser.add_argument('--image-map', dest='image_map', action='store',
+    help='Write an HTML image map of the links')
+  parser.add_argument('--shard', dest='shard', action='store', type=shard_arg, metavar='INDEX/COUNT',
+    help='Render only one shard of a batch')
+  parser.add_argument('--manifest', dest='manifest', action='store',
+    help='Write a JSON manifest of a batch render')
+  parser.add_argument('--merge-manifests', dest='merge_manifests', action='store_true', default=False,
+    help='Combine shard manifests into one')
+  parser.add_argument('--worker', dest='worker', action='store_true', default=False,
+    help='Answer JSON render requests on stdin')
   parser.add_argument('-v', '--version', dest='version', action='store_true', default=False, help='Syntrax version')
   parser.add_argument('--get-style', dest='get_style', action='store_true', default=False,
     help='Create default style .ini')
@@ -1999,17 +4270,43 @@ def parse_args():
     sys.exit(0)
 
   # Allow file to be passed in without -i
+  args.inputs = ([args.input] if args.input is not None else []) + unparsed
   if args.input is None and len(unparsed) > 0:
     args.input = unparsed[0]
 
+  if args.worker: # Inputs and outputs come with each request
+    args.scale = float(args.scale)
+    return args
+
   if args.input is None:
     print('Error: input file is required')
     sys.exit(1)
+
+  if args.input == '-' or args.output == '-':
+    if args.sprites or args.watch or args.shard is not None or len(args.inputs) > 1 or \
+        os.path.splitext(args.input)[1].lower() == '.ebnf':
+      print('Error: only one diagram can be read from stdin or written to stdout')
+      sys.exit(1)
+
+  if args.input == '-' and args.output is None and not args.measure:
+    print('Error: output file is required when reading from stdin')
+    sys.exit(1)
+
+  if args.output == '-' and args.format is None:
+    print('Error: --format is required when writing to stdout')
+    sys.exit(1)
+
+  if args.output == '-' and args.split_pixels is not None:
+    print('Error: split diagrams can\'t be written to stdout')
+    sys.exit(1)
     
+  if args.output is None and args.merge_manifests:
+    args.output = 'manifest.json'
+
   if args.output is None: # Default to png
-    args.output = os.path.splitext(args.input)[0] + '.png'
+    args.output = os.path.splitext(args.input)[0] + ('.svg' if args.sprites else '.png')
 
-  if args.output.lower() in ('png', 'svg', 'pdf', 'ps', 'eps'):
+  if args.output.lower() in ('png', 'svg', 'svgz', 'pdf', 'ps', 'eps', 'sdl', 'json'):
     args.output = os.path.splitext(args.input)[0] + '.' + args.output.lower()
 
   args.scale = float(args.scale)
@@ -2019,24 +4316,539 @@ def parse_args():
 
 def main():  
   args = parse_args()
+
+  limits = RenderLimits(args.max_nodes, args.max_depth, args.max_shapes, args.max_pixels, args.time_limit)
+
+  if args.worker:
+    serve_worker(args, limits)
+    return
+
+  if args.watch:
+    watch_inputs(args, limits)
+    return
+
+  if args.merge_manifests:
+    merge_manifests(args.inputs, args.output)
+    return
+
+  if args.output == '-': # Keep status messages out of the output
+    args.stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+    sys.stdout = sys.stderr
   
   # Process styles
-  styles = parse_style_config(args.styles)
+  styles = read_styles(args.styles, args, args.scale)
+
+  try:
+    render_inputs(args, styles, limits)
+  except (LimitError, SpecError) as e:
+    print('Error: {}'.format(e))
+    sys.exit(1)
 
-  spec, url_map = parse_spec_file(args.input)
 
-  #print('## spec', spec)
+def read_styles(style_file, args, scale):
+  '''Read a style file and apply the style options from the command line
+
+  The --max-width option is converted to unscaled pixels using scale.
+  '''
+  styles = parse_style_config(style_file)
+  if args.max_width is not None: # Width of the scaled image
+    styles.max_width = args.max_width / scale
+  return styles
+
+def render_inputs(args, styles, limits):
+  '''Render the input files selected on the command line'''
+
+  # Text measurement for the SVG backend
+  text_bbox = cairo_text_bbox
+  if args.metrics == 'builtin' or len(args.font_dirs) > 0:
+    text_bbox = MetricsTextBBox(args.font_dirs)
+
+  if args.measure: # Only report the size of each diagram
+    measure_inputs(args, styles, text_bbox, limits)
+    return
+
+  if os.path.splitext(args.input)[1].lower() == '.ebnf':
+    render_grammar(args, styles, text_bbox, limits)
+    return
+
+  if args.sprites:
+    diagrams = []
+    for fname in args.inputs:
+      spec, url_map = parse_spec_file(fname, limits)
+      # Symbol id from the file name
+      name = diagram_name(os.path.splitext(os.path.basename(fname))[0])
+      diagrams.append((name, spec, None, url_map))
+
+    render_svg_sprites(diagrams, args.output, styles, args.transparent, args.compact, args.precision,
+      args.dedup, text_bbox, limits)
+    return
+
+  if len(args.inputs) > 1 and os.path.splitext(args.output)[1].lower() == '.pdf':
+    diagrams = []
+    for fname in args.inputs:
+      spec, url_map = parse_spec_file(fname, limits)
+      name = os.path.splitext(os.path.basename(fname))[0]
+      diagrams.append((name, spec, name if args.page_titles else None, url_map))
+
+    render_pdf_pages(diagrams, args.output, styles, args.scale, args.transparent, limits)
+    return
 
   # Force SVG backend for SVG output
-  backend = 'cairo'
-  if os.path.splitext(args.output)[1].lower() == '.svg':
-    backend = 'svg'
+  fmt = args.format or os.path.splitext(args.output)[1][1:].lower()
+  ext = '.' + fmt
+  backend = format_backend(fmt)
+
+  out_file, out_name = args.output, args.output
+  if args.output == '-':
+    out_file, out_name = args.stdout, 'stdout'
+
+  if args.shard is not None or len(args.inputs) > 1 or os.path.isdir(args.input):
+    if backend == 'cairo':
+      text_bbox = cairo_text_bbox
+    render_batch(args, ext, backend, styles, text_bbox, limits)
+    return
+
+  if os.path.splitext(args.input)[1].lower() == '.sdl': # Draw a saved display list
+    rc, bbox, styles = load_display_list(args.input)
+    print('Rendering to {} using {} backend'.format(out_name, backend))
+    render_canvas(rc, bbox, out_file, backend, styles, args.scale, args.transparent,
+      args.compact, args.precision, args.dedup, limits, fmt)
+    return
+
+  spec, url_map = parse_spec_file(args.input, limits)
+
+  #print('## spec', spec)
+
+  if ext == '.sdl': # Save layout for later rendering
+    print('Saving display list to {}'.format(args.output))
+    rc, bbox = layout_railroad(spec, args.title, url_map, styles, text_bbox, limits)
+    save_display_list(rc, bbox, styles, args.output)
+    return
   
   #title = 'JSON syntax number'
   #title = None
 
-  render_railroad(spec, args.title, url_map, args.output, backend, styles, args.scale, args.transparent)
+  if backend == 'cairo': # Cairo draws text with Pango so it must also be measured with Pango
+    text_bbox = cairo_text_bbox
+
+  if args.split_pixels is not None:
+    parts = render_parts(args, spec, url_map, args.output, fmt, backend, styles, text_bbox, limits)
+    if len(parts) > 1:
+      manifest_file = args.manifest or os.path.splitext(args.output)[0] + '-parts.json'
+      print('Writing manifest to {}'.format(manifest_file))
+      with open(manifest_file, 'w') as fh:
+        json.dump({'input': args.input, 'parts': parts}, fh, indent=2, sort_keys=True)
+    return
+
+  print('Rendering to {} using {} backend'.format(out_name, backend))
+  rc, bbox = layout_railroad(spec, args.title, url_map, styles, text_bbox, limits)
+
+  if args.region is not None:
+    rc, bbox = crop_canvas(rc, bbox, styles, args.region, args.scale)
+
+  if args.image_map is not None:
+    name = os.path.splitext(os.path.basename(args.input))[0]
+    print('Writing image map to {}'.format(args.image_map))
+    with io.open(args.image_map, 'w', encoding='utf-8') as fh:
+      fh.write(html_image_map(ShapeIndex(rc, bbox, styles, args.scale), name))
+
+  render_canvas(rc, bbox, out_file, backend, styles, args.scale, args.transparent,
+    args.compact, args.precision, args.dedup, limits, fmt)
+
+def render_parts(args, spec, url_map, out_file, fmt, backend, styles, text_bbox, limits):
+  '''Render a diagram split into parts no larger than --split-pixels
+
+  Parts are written next to out_file with their number added to its name.
+  A diagram that fits is written to out_file. Returns a list with the file,
+  width, and height of each part.
+  '''
+  base, ext = os.path.splitext(out_file)
+  part_url = os.path.basename(base) + '-{}' + ext
+  parts = split_railroad(spec, args.title, url_map, styles, args.split_pixels, args.scale, text_bbox,
+    limits, part_url)
+
+  written = []
+  for num, (part, title, part_map) in enumerate(parts, 1):
+    part_file = out_file if len(parts) == 1 else part_url.format(num)
+    part_file = os.path.join(os.path.dirname(out_file), part_file)
+    print('Rendering to {} using {} backend'.format(part_file, backend))
+    rc, bbox = layout_railroad(part, title, part_map, styles, text_bbox, limits)
+    render_canvas(rc, bbox, part_file, backend, styles, args.scale, args.transparent,
+      args.compact, args.precision, args.dedup, limits, fmt)
+
+    W, H = diagram_size(bbox, styles, args.scale)
+    written.append({'part': num, 'output': part_file, 'width': W, 'height': H})
+
+  return written
   
+def measure_inputs(args, styles, text_bbox, limits):
+  '''Report the size of each input diagram
+
+  Every production of an EBNF grammar is measured separately. Saved display
+  lists are already laid out so their size comes from the stored bounding box.
+  '''
+  for fname in args.inputs:
+    in_ext = os.path.splitext(fname)[1].lower()
+    if in_ext == '.ebnf':
+      for name, spec in parse_ebnf_file(fname):
+        W, H = measure_railroad(spec, name, {}, styles, args.scale, text_bbox, limits)
+        print('{}: {}: {} x {}'.format(fname, name, W, H))
+
+    elif in_ext == '.sdl':
+      rc, bbox, sdl_styles = load_display_list(fname)
+      W, H = diagram_size(bbox, sdl_styles, args.scale)
+      print('{}: {} x {}'.format(fname, W, H))
+
+    else:
+      spec, url_map = parse_spec_file(fname, limits)
+      W, H = measure_railroad(spec, args.title, url_map, styles, args.scale, text_bbox, limits)
+      print('{}: {} x {}'.format(fname, W, H))
+
+def render_grammar(args, styles, text_bbox, limits):
+  '''Render every production in an EBNF grammar
+
+  Each production is titled with its name and nonterminals link to the
+  diagrams of their productions.
+  '''
+  prods = parse_ebnf_file(args.input)
+  names = [name for name, spec in prods]
+  base, ext = os.path.splitext(args.output)
+  ext = ext.lower()
+
+  out_dir = os.path.dirname(args.output)
+  if out_dir and not os.path.isdir(out_dir):
+    os.makedirs(out_dir)
+
+  if args.sprites:
+    url_map = ebnf_url_map(names, '#{}')
+    diagrams = [(diagram_name(name), spec, name, url_map) for name, spec in prods]
+    render_svg_sprites(diagrams, args.output, styles, args.transparent, args.compact, args.precision,
+      args.dedup, text_bbox, limits)
+
+  elif ext == '.pdf':
+    diagrams = [(name, spec, name, {}) for name, spec in prods]
+    render_pdf_pages(diagrams, args.output, styles, args.scale, args.transparent, limits)
+
+  else: # One file per production in the output directory
+    backend = format_backend(ext[1:])
+    if backend == 'cairo':
+      text_bbox = cairo_text_bbox
+
+    # A named output file is a prefix for the production names
+    prefix = ''
+    if base != os.path.splitext(args.input)[0]:
+      prefix = os.path.basename(base) + '-'
+    url_map = ebnf_url_map(names, prefix + '{}' + ext)
+
+    with RenderSession(styles, text_bbox, limits=limits) as session:
+      for name, spec in prods:
+        out_file = os.path.join(out_dir, prefix + diagram_name(name) + ext)
+        print('Rendering to {} using {} backend'.format(out_file, backend))
+        session.render(spec, name, url_map, out_file, backend, args.scale, args.transparent,
+          args.compact, args.precision, args.dedup)
+
+
+def spec_files(paths):
+  '''Expand directories in a list of inputs into the .spec files they hold'''
+  files = []
+  for path in paths:
+    if os.path.isdir(path):
+      files.extend(os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith('.spec'))
+    else:
+      files.append(path)
+  return files
+
+def region_arg(value):
+  '''Parse an X0,Y0,X1,Y1 image region'''
+  try:
+    x0, y0, x1, y1 = [float(v) for v in value.split(',')]
+  except ValueError:
+    raise argparse.ArgumentTypeError('Region must be X0,Y0,X1,Y1: "{}"'.format(value))
+  if x1 <= x0 or y1 <= y0:
+    raise argparse.ArgumentTypeError('Region is empty: "{}"'.format(value))
+  return (x0, y0, x1, y1)
+
+def shard_arg(value):
+  '''Parse an INDEX/COUNT shard selection with a 1-based index'''
+  m = re.match(r'^(\d+)/(\d+)$', value)
+  if m is None:
+    raise argparse.ArgumentTypeError('Shard must be INDEX/COUNT: "{}"'.format(value))
+  index, count = int(m.group(1)), int(m.group(2))
+  if count < 1 or not 1 <= index <= count:
+    raise argparse.ArgumentTypeError('Shard index must be from 1 to COUNT: "{}"'.format(value))
+  return (index, count)
+
+def shard_specs(files, index, count):
+  '''Select the spec files rendered by one shard of a batch
+
+  Every shard reads all of the files and computes the same assignment so no
+  coordination is needed between them. The size of a spec file is its
+  estimated cost. Specs are placed on the least loaded shard from most to
+  least costly with ties ordered by content hash. The loads of any two
+  shards differ by no more than the cost of the largest spec. Other shards'
+  specs are hashed but never parsed.
+
+  Returns a list of (file name, content hash, cost) for the shard.
+  '''
+  jobs = []
+  for fname in files:
+    with open(fname, 'rb') as fh:
+      data = fh.read()
+    jobs.append((len(data), hashlib.sha1(data).hexdigest(), fname))
+
+  jobs.sort(key=lambda j: (-j[0], j[1], j[2]))
+
+  loads = [0] * count
+  selected = []
+  for cost, digest, fname in jobs:
+    shard = loads.index(min(loads))
+    loads[shard] += cost
+    if shard == index - 1:
+      selected.append((fname, digest, cost))
+
+  return selected
+
+def render_batch(args, ext, backend, styles, text_bbox, limits):
+  '''Render each input spec to its own file
+
+  With --shard only the specs assigned to that shard are rendered. The
+  --manifest option records what was rendered for merging later.
+  '''
+  files = spec_files(args.inputs)
+  index, count = args.shard if args.shard is not None else (1, 1)
+  jobs = shard_specs(files, index, count)
+
+  if count > 1:
+    print('Shard {} of {}: {} of {} specs'.format(index, count, len(jobs), len(files)))
+
+  diagrams = []
+  with RenderSession(styles, text_bbox, limits=limits) as session:
+    for fname, digest, cost in jobs:
+      spec, url_map = parse_spec_file(fname, limits)
+      out_file = os.path.splitext(fname)[0] + ext
+      entry = {'input': fname, 'output': out_file, 'hash': digest, 'cost': cost}
+
+      if args.split_pixels is not None:
+        parts = render_parts(args, spec, url_map, out_file, ext[1:], backend, styles, session.text_bbox,
+          limits)
+        if len(parts) > 1:
+          entry['parts'] = parts
+      else:
+        print('Rendering to {} using {} backend'.format(out_file, backend))
+        session.render(spec, args.title, url_map, out_file, backend, args.scale, args.transparent,
+          args.compact, args.precision, args.dedup)
+
+      diagrams.append(entry)
+
+  if args.manifest is not None:
+    manifest = {'shard': [index, count], 'diagrams': diagrams}
+    with open(args.manifest, 'w') as fh:
+      json.dump(manifest, fh, indent=2, sort_keys=True)
+
+def merge_manifests(manifest_files, out_file):
+  '''Combine the manifests written by each shard of a batch
+
+  Every shard from 1 to COUNT must be present exactly once.
+  '''
+  shards = {}
+  count = None
+  for fname in manifest_files:
+    with open(fname, 'r') as fh:
+      manifest = json.load(fh)
+    index, shard_count = manifest['shard']
+    if count is None:
+      count = shard_count
+    if shard_count != count:
+      print('Error: {} is from a batch of {} shards, not {}'.format(fname, shard_count, count))
+      sys.exit(1)
+    if index in shards:
+      print('Error: shard {} is in both {} and {}'.format(index, shards[index][0], fname))
+      sys.exit(1)
+    shards[index] = (fname, manifest['diagrams'])
+
+  missing = [str(i) for i in range(1, (count or 0) + 1) if i not in shards]
+  if len(missing) > 0:
+    print('Error: missing manifests for shards {}'.format(', '.join(missing)))
+    sys.exit(1)
+
+  diagrams = sorted((d for fname, ds in shards.values() for d in ds), key=lambda d: d['input'])
+  print('Merging {} diagrams from {} shards into {}'.format(len(diagrams), len(shards), out_file))
+  with open(out_file, 'w') as fh:
+    json.dump({'shards': count, 'diagrams': diagrams}, fh, indent=2, sort_keys=True)
+
+
+# Seconds between checks for changed files in watch mode
+watch_interval = 0.5
+# Seconds that files must stay unchanged before rendering
+watch_debounce = 0.3
+
+def watch_inputs(args, limits):
+  '''Render specs whenever they change until interrupted
+
+  Inputs can be spec files or directories of .spec files. Only specs with
+  new content are rendered unless the style file changes.
+  '''
+  ext = os.path.splitext(args.output)[1].lower()
+  backend = format_backend(ext[1:])
+  single = len(args.inputs) == 1 and not os.path.isdir(args.inputs[0])
+
+  if backend == 'cairo': # Cairo draws text with Pango so it must also be measured with Pango
+    text_bbox = cairo_text_bbox
+  elif args.metrics == 'builtin' or len(args.font_dirs) > 0:
+    text_bbox = MetricsTextBBox(args.font_dirs)
+  else:
+    text_bbox = cairo_text_bbox
+
+  def file_states():
+    states = {}
+    for fname in spec_files(args.inputs) + [args.styles]:
+      try:
+        st = os.stat(fname)
+        states[fname] = (st.st_mtime, st.st_size)
+      except OSError:
+        states[fname] = None
+    return states
+
+  print('Watching {} for changes. Press Ctrl-C to stop.'.format(', '.join(args.inputs)))
+
+  session = None
+  contents = {} # Spec text last rendered for each file
+  states = {}
+  try:
+    while True:
+      current = file_states()
+      if current == states:
+        time.sleep(watch_interval)
+        continue
+
+      # Wait for a burst of saves to finish
+      while True:
+        time.sleep(watch_debounce)
+        settled = file_states()
+        if settled == current:
+          break
+        current = settled
+
+      if session is None or current[args.styles] != states.get(args.styles, None):
+        try:
+          session = RenderSession(read_styles(args.styles, args, args.scale), text_bbox, limits=limits)
+          contents = {} # Render everything with the new styles
+        except Exception as e: # Keep the last good styles after a bad edit
+          print('Error: unable to read styles "{}": {}'.format(args.styles, e))
+          if session is None:
+            states = current
+            continue
+
+      for fname in spec_files(args.inputs):
+        if current.get(fname, None) is None or fname == args.styles:
+          continue
+        try:
+          with io.open(fname, 'r', encoding='utf-8') as fh:
+            spec_text = fh.read()
+          if contents.get(fname, None) == spec_text:
+            continue
+          contents[fname] = spec_text
+
+          spec, url_map = parse_spec(spec_text, limits)
+          out_file = args.output if single else os.path.splitext(fname)[0] + ext
+          print('Rendering to {} using {} backend'.format(out_file, backend))
+          session.render(spec, args.title, url_map, out_file, backend, args.scale, args.transparent,
+            args.compact, args.precision, args.dedup)
+        except Exception as e: # Keep watching after bad edits
+          print('Error: unable to render "{}": {}'.format(fname, e))
+
+      states = current
+
+  except KeyboardInterrupt:
+    pass
+
+
+def serve_worker(args, limits):
+  '''Render diagrams requested on stdin until it is closed
+
+  Each request is a line of JSON with the spec file in "input" or the spec
+  text in "spec" and the file to write in "output". The optional "format",
+  "style", "scale", "title", and "transparent" fields override the command
+  line. Any "id" is copied into the reply. One line of JSON is written to
+  stdout for each request with its "status", the "time" taken in seconds,
+  and either the "width" and "height" of the diagram or an "error".
+
+  Styles and text measurements are kept between requests. A style file is
+  read again when it changes.
+  '''
+  replies = sys.stdout
+  sys.stdout = sys.stderr # Keep status messages out of the replies
+
+  if args.metrics == 'builtin' or len(args.font_dirs) > 0:
+    text_bbox = MetricsTextBBox(args.font_dirs)
+  else:
+    text_bbox = cairo_text_bbox
+
+  sessions = {} # (style file, Pango metrics, scale) -> (style file mtime, RenderSession)
+
+  def get_session(style_file, use_pango, scale):
+    try:
+      mtime = os.stat(style_file).st_mtime
+    except OSError:
+      mtime = None
+
+    # The styles only depend on the scale through --max-width
+    key = (style_file, use_pango, scale if args.max_width is not None else None)
+    if key not in sessions or sessions[key][0] != mtime:
+      session = RenderSession(read_styles(style_file, args, scale),
+        cairo_text_bbox if use_pango else text_bbox, limits=limits)
+      sessions[key] = (mtime, session)
+    return sessions[key][1]
+
+  try:
+    for line in iter(sys.stdin.readline, ''):
+      if not line.strip():
+        continue
+
+      start = time.time()
+      reply = {}
+      try:
+        req = json.loads(line)
+        reply['id'] = req.get('id', None)
+
+        out_file = req['output']
+        fmt = req.get('format', None) or os.path.splitext(out_file)[1][1:]
+        fmt = fmt.lower()
+        backend = format_backend(fmt)
+
+        if 'spec' in req:
+          spec, url_map = parse_spec(req['spec'], limits)
+        else:
+          spec, url_map = parse_spec_file(req['input'], limits)
+
+        scale = float(req.get('scale', args.scale))
+        session = get_session(req.get('style', args.styles), backend == 'cairo', scale)
+
+        rc, bbox = session.layout(spec, req.get('title', args.title), url_map)
+        try:
+          drawing = draw_canvas(rc, bbox, fmt, backend, session.styles, scale,
+            req.get('transparent', args.transparent), args.compact, args.precision, args.dedup, limits)
+          with open(out_file, 'wb') as fh:
+            fh.write(encode_drawing(drawing, fmt, backend))
+        finally:
+          session.release()
+
+        reply['status'] = 'ok'
+        reply['width'], reply['height'] = diagram_size(bbox, session.styles, scale)
+
+      except Exception as e: # Report the failure and wait for the next request
+        reply['status'] = 'error'
+        reply['error'] = '{}: {}'.format(type(e).__name__, e)
+
+      reply['time'] = round(time.time() - start, 6)
+      replies.write(json.dumps(reply, sort_keys=True) + '\n')
+      replies.flush()
+
+  except KeyboardInterrupt:
+    pass
+  finally:
+    sys.stdout = replies
+
 
 if __name__ == '__main__':
   main()
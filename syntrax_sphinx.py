@@ -0,0 +1,259 @@
+#!/usr/bin/python
+
+'''Sphinx extension for rendering Syntrax diagrams
+
+Add 'syntrax_sphinx' to the extensions in conf.py and place diagram specs in
+a syntrax directive:
+
+  .. syntrax::
+    :title: Numbers
+
+    line(opt('-'), choice('0', '1-9'))
+
+Diagrams are rendered into the image directory of the output with a file
+name derived from a hash of the spec, the style file, and the options. An
+image that already exists from a previous build is reused. Diagrams that
+need rendering are collected while documents are read and are rendered
+together in a pool of worker processes once reading is finished.
+'''
+
+from __future__ import print_function
+
+import os
+import hashlib
+import multiprocessing
+
+from docutils import nodes
+from docutils.parsers.rst import Directive, directives
+
+from sphinx.util import logging
+
+import syntrax
+
+logger = logging.getLogger(__name__)
+
+
+class syntrax_diagram(nodes.General, nodes.Inline, nodes.Element):
+  pass
+
+
+def align_spec(argument):
+  return directives.choice(argument, ('left', 'center', 'right'))
+
+
+class SyntraxDirective(Directive):
+  '''Directive to insert a railroad diagram'''
+  has_content = True
+  required_arguments = 0
+  optional_arguments = 0
+  option_spec = {
+    'title': directives.unchanged,
+    'scale': directives.positive_int,
+    'style': directives.unchanged,
+    'transparent': directives.flag,
+    'alt': directives.unchanged,
+    'align': align_spec,
+    'class': directives.class_option
+  }
+
+  def run(self):
+    env = self.state.document.settings.env
+
+    if len(self.content) == 0:
+      return [self.state_machine.reporter.warning('Syntrax directive has no spec', line=self.lineno)]
+
+    spec_text = u'\n'.join(self.content)
+
+    # Style file relative to the source directory
+    style_file = self.options.get('style', env.config.syntrax_style)
+    if style_file:
+      style_file = os.path.join(env.srcdir, style_file)
+      env.note_dependency(style_file)
+
+    job = {
+      'spec': spec_text,
+      'style': style_file,
+      'title': self.options.get('title', None),
+      'scale': self.options.get('scale', 100) / 100.0,
+      'transparent': 'transparent' in self.options,
+      'metrics': env.config.syntrax_metrics
+    }
+    key = job_key(job)
+
+    if not hasattr(env, 'syntrax_jobs'):
+      env.syntrax_jobs = {}
+    env.syntrax_jobs.setdefault(env.docname, {})[key] = job
+
+    node = syntrax_diagram()
+    node['key'] = key
+    node['alt'] = self.options.get('alt', job['title'] or 'Railroad diagram')
+    node['classes'] = self.options.get('class', [])
+    if 'align' in self.options:
+      node['align'] = self.options['align']
+
+    return [node]
+
+
+def job_key(job):
+  '''Hash everything that affects the rendered image'''
+  h = hashlib.sha1()
+  h.update(job['spec'].encode('utf-8'))
+
+  if job['style'] and os.path.exists(job['style']):
+    with open(job['style'], 'rb') as fh:
+      h.update(fh.read())
+
+  opts = u'{}|{}|{}|{}|{}'.format(job['title'], job['scale'], job['transparent'], job['metrics'],
+    syntrax.__version__)
+  h.update(opts.encode('utf-8'))
+  return h.hexdigest()
+
+
+def render_job(job, out_file):
+  '''Render one diagram. This runs in the worker processes.'''
+  fmt = os.path.splitext(out_file)[1][1:].lower()
+  backend = syntrax.format_backend(fmt)
+
+  styles = syntrax.parse_style_config(job['style']) if job['style'] else syntrax.DrawStyle()
+
+  if backend != 'cairo' and job['metrics'] == 'builtin':
+    text_bbox = syntrax.MetricsTextBBox()
+  else:
+    text_bbox = syntrax.cairo_text_bbox
+
+  spec, url_map = syntrax.parse_spec(job['spec'])
+  rc, bbox = syntrax.layout_railroad(spec, job['title'], url_map, styles, text_bbox)
+
+  # Write to a temporary name so that an interrupted build leaves no partial image
+  tmp_file = out_file + '.tmp'
+  syntrax.render_canvas(rc, bbox, tmp_file, backend, styles, job['scale'], job['transparent'],
+    fmt=fmt)
+  os.rename(tmp_file, out_file)
+
+def _render_job(args):
+  job, out_file = args
+  try:
+    render_job(job, out_file)
+    return None
+  except Exception as e:
+    return '{}: {}'.format(type(e).__name__, e)
+
+
+def output_format(builder):
+  '''Get the image format for a builder or None if it doesn't use images'''
+  if builder.format == 'latex':
+    return 'pdf'
+  elif builder.format == 'html':
+    return builder.config.syntrax_output_format
+  return None
+
+def image_dir(builder):
+  return os.path.join(builder.outdir, getattr(builder, 'imagedir', ''))
+
+
+def render_pending(app, env):
+  '''Render all diagrams without an existing image after the read phase'''
+  fmt = output_format(app.builder)
+  if fmt is None:
+    return
+
+  out_dir = image_dir(app.builder)
+
+  pending = {}
+  for jobs in getattr(env, 'syntrax_jobs', {}).values():
+    for key, job in jobs.items():
+      out_file = os.path.join(out_dir, 'syntrax-{}.{}'.format(key, fmt))
+      if not os.path.exists(out_file):
+        pending[key] = (job, out_file)
+
+  if len(pending) == 0:
+    return
+
+  if not os.path.isdir(out_dir):
+    os.makedirs(out_dir)
+
+  workers = app.config.syntrax_workers or multiprocessing.cpu_count()
+  workers = min(workers, len(pending))
+  logger.info('rendering {} syntrax diagrams with {} workers'.format(len(pending), workers))
+
+  jobs = list(pending.values())
+  if workers > 1:
+    pool = multiprocessing.Pool(workers)
+    try:
+      errors = pool.map(_render_job, jobs)
+    finally:
+      pool.close()
+      pool.join()
+  else:
+    errors = [_render_job(j) for j in jobs]
+
+  for (job, out_file), err in zip(jobs, errors):
+    if err is not None:
+      logger.warning('syntrax: unable to render {}: {}'.format(os.path.basename(out_file), err))
+
+
+def purge_doc(app, env, docname):
+  if hasattr(env, 'syntrax_jobs'):
+    env.syntrax_jobs.pop(docname, None)
+
+def merge_info(app, env, docnames, other):
+  if not hasattr(env, 'syntrax_jobs'):
+    env.syntrax_jobs = {}
+  for docname in docnames:
+    if docname in getattr(other, 'syntrax_jobs', {}):
+      env.syntrax_jobs[docname] = other.syntrax_jobs[docname]
+
+
+def image_name(builder, node):
+  return 'syntrax-{}.{}'.format(node['key'], output_format(builder))
+
+def html_visit_syntrax(self, node):
+  fname = image_name(self.builder, node)
+  src = '{}/{}'.format(self.builder.imgpath, fname)
+
+  classes = ' '.join(['syntrax'] + node['classes'])
+  if 'align' in node:
+    classes += ' align-{}'.format(node['align'])
+
+  if not os.path.exists(os.path.join(image_dir(self.builder), fname)):
+    self.body.append(u'<p class="warning">{}</p>'.format(self.encode(node['alt'])))
+  elif fname.endswith('.svg'): # Embed as an object so hyperlinks work
+    self.body.append(u'<div class="{}"><object data="{}" type="image/svg+xml">{}</object></div>'.format(
+      classes, src, self.encode(node['alt'])))
+  else:
+    self.body.append(u'<div class="{}"><img src="{}" alt="{}"/></div>'.format(classes, src,
+      self.encode(node['alt'])))
+  raise nodes.SkipNode
+
+def latex_visit_syntrax(self, node):
+  fname = image_name(self.builder, node)
+  self.body.append(u'\n\n\\includegraphics{{{}}}\n\n'.format(fname))
+  raise nodes.SkipNode
+
+def text_visit_syntrax(self, node):
+  self.add_text(u'[diagram: {}]'.format(node['alt']))
+  raise nodes.SkipNode
+
+def skip_syntrax(self, node):
+  raise nodes.SkipNode
+
+
+def setup(app):
+  app.add_node(syntrax_diagram,
+    html=(html_visit_syntrax, None),
+    latex=(latex_visit_syntrax, None),
+    text=(text_visit_syntrax, None),
+    man=(skip_syntrax, None),
+    texinfo=(skip_syntrax, None))
+  app.add_directive('syntrax', SyntraxDirective)
+
+  app.add_config_value('syntrax_style', None, 'html')
+  app.add_config_value('syntrax_output_format', 'svg', 'html')
+  app.add_config_value('syntrax_metrics', 'pango', 'html')
+  app.add_config_value('syntrax_workers', 0, '')
+
+  app.connect('env-purge-doc', purge_doc)
+  app.connect('env-merge-info', merge_info)
+  app.connect('env-updated', render_pending)
+
+  return {'version': syntrax.__version__, 'parallel_read_safe': True, 'parallel_write_safe': True}
@@ -0,0 +1,144 @@
+'''Background rendering with render_async()'''
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import syntrax
+
+try:
+  import asyncio
+except ImportError:
+  asyncio = None
+
+
+class TrackedTextBBox(object):
+  '''Builtin metrics that record how many renders are measuring text at once'''
+  def __init__(self, delay=0.0):
+    self.measure = syntrax.MetricsTextBBox()
+    self.delay = delay
+    self.lock = threading.Lock()
+    self.active = 0
+    self.most_active = 0
+    self.release = threading.Event()
+    self.release.set()
+    self.started = threading.Event()
+
+  def __call__(self, text, font_params, scale=1.0):
+    with self.lock:
+      self.active += 1
+      self.most_active = max(self.most_active, self.active)
+    self.started.set()
+    try:
+      self.release.wait()
+      time.sleep(self.delay)
+      return self.measure(text, font_params, scale)
+    finally:
+      with self.lock:
+        self.active -= 1
+
+
+def spec_text(i):
+  return u"line('start', loop('item {}', ','), opt('end'))".format(i)
+
+
+class TestRenderAsync(unittest.TestCase):
+  def setUp(self):
+    self.styles = syntrax.DrawStyle()
+    self.pool = syntrax.RenderPool(2)
+
+  def tearDown(self):
+    self.pool.shutdown()
+
+  def serial(self, text):
+    spec, url_map = syntrax.parse_spec(text)
+    rc, bbox = syntrax.layout_railroad(spec, None, url_map, self.styles, syntrax.MetricsTextBBox())
+    drawing = syntrax.draw_canvas(rc, bbox, 'svg', 'svg', self.styles, 1.0, False)
+    return syntrax.encode_drawing(drawing, 'svg', 'svg')
+
+  def test_bounded_concurrency(self):
+    text_bbox = TrackedTextBBox(0.002)
+    futures = [syntrax.render_async(spec_text(i), self.styles, 'svg', text_bbox=text_bbox,
+      executor=self.pool) for i in range(8)]
+
+    for i, f in enumerate(futures):
+      self.assertEqual(f.result(30), self.serial(spec_text(i)))
+    self.assertEqual(text_bbox.most_active, 2)
+    self.assertEqual(len(self.pool.threads), 2)
+
+  def test_cancel_queued(self):
+    text_bbox = TrackedTextBBox()
+    text_bbox.release.clear() # Hold both workers in layout
+    running = [syntrax.render_async(spec_text(i), self.styles, text_bbox=text_bbox, executor=self.pool)
+      for i in range(2)]
+    queued = syntrax.render_async(spec_text(2), self.styles, text_bbox=text_bbox, executor=self.pool)
+
+    self.assertTrue(queued.cancel())
+    self.assertFalse(queued.cancel())
+    text_bbox.release.set()
+
+    self.assertTrue(queued.cancelled())
+    self.assertRaises(syntrax.RenderCancelled, queued.result, 30)
+    for f in running:
+      self.assertTrue(len(f.result(30)) > 0)
+
+  def test_cancel_between_phases(self):
+    text_bbox = TrackedTextBBox()
+    text_bbox.release.clear()
+    phases = []
+    draw_canvas = syntrax.draw_canvas
+    def tracked_draw(*args, **kwargs):
+      phases.append('draw')
+      return draw_canvas(*args, **kwargs)
+    syntrax.draw_canvas = tracked_draw
+    try:
+      f = syntrax.render_async(spec_text(0), self.styles, text_bbox=text_bbox, executor=self.pool)
+      self.assertTrue(text_bbox.started.wait(30)) # In the layout phase
+      self.assertTrue(f.cancel())
+      text_bbox.release.set()
+      self.pool.shutdown() # Wait for the worker to finish the layout
+    finally:
+      syntrax.draw_canvas = draw_canvas
+
+    self.assertEqual(phases, [])
+    self.assertRaises(syntrax.RenderCancelled, f.result, 0)
+
+  def test_error(self):
+    f = syntrax.render_async(u"open('x')", self.styles, executor=self.pool)
+    self.assertRaises(syntrax.SpecError, f.result, 30)
+
+  @unittest.skipIf(asyncio is None, 'asyncio is not available')
+  def test_await(self):
+    loop = asyncio.new_event_loop()
+    try:
+      f = syntrax.render_async(spec_text(0), self.styles, text_bbox=syntrax.MetricsTextBBox(),
+        executor=self.pool)
+      svg = loop.run_until_complete(f)
+    finally:
+      loop.close()
+    self.assertEqual(svg, self.serial(spec_text(0)))
+
+  @unittest.skipIf(asyncio is None, 'asyncio is not available')
+  def test_await_cancel(self):
+    text_bbox = TrackedTextBBox()
+    text_bbox.release.clear()
+    loop = asyncio.new_event_loop()
+    try:
+      f = syntrax.render_async(spec_text(0), self.styles, text_bbox=text_bbox, executor=self.pool)
+      task = asyncio.ensure_future(f, loop=loop)
+      loop.run_until_complete(asyncio.sleep(0.01))
+      task.cancel()
+      self.assertRaises(asyncio.CancelledError, loop.run_until_complete, task)
+    finally:
+      text_bbox.release.set()
+      loop.close()
+    self.assertTrue(f.cancelled())
+
+
+if __name__ == '__main__':
+  unittest.main()
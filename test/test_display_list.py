@@ -0,0 +1,55 @@
+'''Saving and loading display lists'''
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import io
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import syntrax
+
+
+class TestDisplayList(unittest.TestCase):
+  def setUp(self):
+    self.out_dir = tempfile.mkdtemp()
+    self.fname = os.path.join(self.out_dir, 'diagram.sdl')
+
+  def tearDown(self):
+    shutil.rmtree(self.out_dir)
+
+  def test_text_mod_not_saved(self):
+    styles = syntrax.DrawStyle()
+    styles.node_styles[0].text_mod = 'lambda txt: txt.upper()'
+    rc, bbox = syntrax.layout_railroad(syntrax.line('a', 'b'), None, {}, styles,
+      syntrax.MetricsTextBBox())
+    syntrax.save_display_list(rc, bbox, styles, self.fname)
+
+    with io.open(self.fname, 'r', encoding='utf-8') as fh:
+      self.assertFalse('text_mod' in fh.read())
+    rc, bbox, styles = syntrax.load_display_list(self.fname)
+    self.assertTrue(len(rc.shapes) > 0)
+
+  def test_text_mod_ignored_on_load(self):
+    styles = syntrax.DrawStyle()
+    rc, bbox = syntrax.layout_railroad(syntrax.line('a'), None, {}, styles,
+      syntrax.MetricsTextBBox())
+    syntrax.save_display_list(rc, bbox, styles, self.fname)
+
+    with io.open(self.fname, 'r', encoding='utf-8') as fh:
+      dl = json.load(fh)
+    for name, ns in dl['node_styles']:
+      ns['text_mod'] = '1/0'
+    with open(self.fname, 'w') as fh:
+      json.dump(dl, fh)
+
+    rc, bbox, styles = syntrax.load_display_list(self.fname)
+    self.assertTrue(all(ns.text_mod_func is None for ns in styles.node_styles))
+
+
+if __name__ == '__main__':
+  unittest.main()
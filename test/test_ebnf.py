@@ -0,0 +1,86 @@
+'''Rendering EBNF grammars'''
+
+from __future__ import print_function
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import syntrax
+
+grammar = u'''
+expr ::= term ('/' term)* 'bullet'?
+term ::= 'term' | "expr"
+'''
+
+
+class TestEbnfTerminals(unittest.TestCase):
+  def setUp(self):
+    self.styles = syntrax.DrawStyle()
+    self.prods = dict(syntrax.EbnfParser(grammar).productions())
+    self.url_map = syntrax.ebnf_url_map(self.prods.keys(), '{}.svg')
+
+  def nodes(self, spec):
+    '''Get the (text, href) of the text in a diagram and the number of bullets'''
+    rc, bbox = syntrax.layout_railroad(['line', 'bullet', spec, 'bullet'], None, self.url_map, self.styles,
+      syntrax.MetricsTextBBox())
+    texts = [(s.options['text'], s.options.get('href', None)) for s in rc.shapes
+      if s.options.get('text', None) is not None]
+    bullets = [s for s in rc.shapes if type(s) is syntrax.OvalShape and s.bbox[2] - s.bbox[0] < 10]
+    return texts, len(bullets)
+
+  def test_terminal_text(self):
+    texts, bullets = self.nodes(self.prods['expr'])
+    self.assertTrue(('/', None) in texts)
+    self.assertTrue(('bullet', None) in texts)
+    self.assertTrue(('term', 'term.svg') in texts)
+    self.assertFalse(('', None) in texts)
+    self.assertEqual(bullets, 2)
+
+  def test_terminal_not_linked(self):
+    texts, bullets = self.nodes(self.prods['term'])
+    self.assertEqual(sorted(texts), [('expr', None), ('term', None)])
+
+  def test_cached_terminal(self):
+    # A terminal and a box with the same text aren't shared in the subtree cache
+    spec = syntrax.line(syntrax.Terminal(u'/term'), u'/term')
+    incr = syntrax.IncrementalLayout(self.styles, self.url_map, syntrax.MetricsTextBBox())
+    rc, bbox = incr.layout(spec)
+    texts = sorted(s.options['text'] for s in rc.shapes if s.options.get('text', None) is not None)
+    self.assertEqual(texts, ['/term', 'term'])
+
+
+class TestRenderGrammar(unittest.TestCase):
+  def setUp(self):
+    self.work_dir = tempfile.mkdtemp()
+    self.input = os.path.join(self.work_dir, 'grammar.ebnf')
+    with open(self.input, 'w') as fh:
+      fh.write(grammar)
+
+  def tearDown(self):
+    shutil.rmtree(self.work_dir)
+
+  def render(self, output):
+    args = argparse.Namespace(input=self.input, output=output, sprites=False, scale=1.0,
+      transparent=False, compact=False, precision=2, dedup=False)
+    syntrax.render_grammar(args, syntrax.DrawStyle(), syntrax.MetricsTextBBox(), None)
+
+  def test_default_names(self):
+    self.render(os.path.join(self.work_dir, 'grammar.svg'))
+    self.assertEqual(sorted(os.listdir(self.work_dir)), ['expr.svg', 'grammar.ebnf', 'term.svg'])
+
+  def test_named_output(self):
+    out_dir = os.path.join(self.work_dir, 'new', 'dir')
+    self.render(os.path.join(out_dir, 'x.svg'))
+    self.assertEqual(sorted(os.listdir(out_dir)), ['x-expr.svg', 'x-term.svg'])
+
+    with open(os.path.join(out_dir, 'x-expr.svg'), 'r') as fh:
+      self.assertTrue('href="x-term.svg"' in fh.read())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,82 @@
+'''Incremental layout gives the same diagram as a full layout'''
+
+from __future__ import print_function
+
+import os
+import sys
+import copy
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import syntrax
+
+edits = 60
+
+
+def random_element(r, depth=0):
+  kind = r.randint(0, 5 if depth < 2 else 0)
+  if kind == 0:
+    return r.choice(['SELECT', 'FROM', '/expr', '/table', 'WHERE', ',', 'x' * r.randint(1, 8)])
+  items = [random_element(r, depth + 1) for _ in range(r.randint(1, 3))]
+  if kind == 1:
+    return syntrax.line(*items)
+  elif kind == 2:
+    return syntrax.choice(*items)
+  elif kind == 3:
+    return syntrax.opt(*items)
+  elif kind == 4:
+    return syntrax.loop(items[0], r.choice([None, ',']))
+  # Options directly in a stack take a bypass that isn't exercised here
+  return syntrax.stack(*[syntrax.line(s) for s in items])
+
+def random_edit(r, spec):
+  '''Replace, insert, or remove one element somewhere in the spec'''
+  spec = copy.deepcopy(spec)
+  parent = spec
+  while True:
+    children = [i for i, s in enumerate(parent) if i > 0 and syntrax.is_listy(s)
+      and s[0] in ('line', 'or', 'opt', 'stack')]
+    if len(children) == 0 or r.random() < 0.4:
+      break
+    parent = parent[r.choice(children)]
+
+  element = random_element(r)
+  if parent[0] == 'stack':
+    element = syntrax.line(element)
+
+  op = r.randint(0, 2)
+  i = r.randint(1, len(parent) - 1) if len(parent) > 1 else 1
+  if op == 0 and len(parent) > 1:
+    parent[i] = element
+  elif op == 1 or len(parent) <= 2:
+    parent.insert(i, element)
+  else:
+    del parent[i]
+  return spec
+
+
+class TestIncrementalLayout(unittest.TestCase):
+  def render(self, rc, bbox, styles):
+    drawing = syntrax.draw_canvas(rc, bbox, 'json', 'json', styles, 1.0, False)
+    return syntrax.encode_drawing(drawing, 'json', 'json')
+
+  def test_random_edits(self):
+    r = random.Random(4)
+    styles = syntrax.DrawStyle()
+    text_bbox = syntrax.MetricsTextBBox()
+    url_map = {'expr': 'expr.html'}
+    incr = syntrax.IncrementalLayout(styles, url_map, text_bbox)
+
+    spec = syntrax.line(*[random_element(r) for _ in range(6)])
+    for n in range(edits):
+      spec = random_edit(r, spec)
+      full = ['line', 'bullet', spec, 'bullet']
+      expected = self.render(*(syntrax.layout_railroad(full, 'Edit', url_map, styles, text_bbox) + (styles,)))
+      actual = self.render(*(incr.layout(copy.deepcopy(full), 'Edit') + (styles,)))
+      self.assertEqual(actual, expected, 'Edit {} differs: {!r}'.format(n, spec))
+      self.assertTrue(len(incr.subtrees) > 0)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,36 @@
+'''Text measurement from font metrics'''
+
+from __future__ import print_function
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import syntrax
+
+
+class TestMetricsTextBBox(unittest.TestCase):
+  def setUp(self):
+    self.font_dir = tempfile.mkdtemp()
+    with open(os.path.join(self.font_dir, 'foo.ttf'), 'wb') as fh:
+      fh.write(b'\0')
+    self.read_font_metrics = syntrax.read_font_metrics
+
+  def tearDown(self):
+    syntrax.read_font_metrics = self.read_font_metrics
+    shutil.rmtree(self.font_dir)
+
+  def test_missing_style_name(self):
+    face = syntrax.FontMetrics(1000, 800, -200, {}, 500, 'Foo', None)
+    syntrax.read_font_metrics = lambda fname: face
+
+    text_bbox = syntrax.MetricsTextBBox([self.font_dir])
+    self.assertTrue(text_bbox.face('Foo', 'normal') is face)
+    self.assertTrue(text_bbox.face('Foo', 'bold') is not face)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,72 @@
+'''Check that a long running RenderSession doesn't grow without bound'''
+
+from __future__ import print_function
+
+import os
+import sys
+import gc
+import glob
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import syntrax
+
+spec_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'doc', 'images')
+
+warmup_renders = 200
+soak_renders = 3000
+# Allowed growth in resident memory after warm-up
+max_growth = 4 * 1024 * 1024
+
+
+def resident_bytes():
+  '''Resident set size of this process from /proc or None when unavailable'''
+  try:
+    with open('/proc/self/statm') as fh:
+      pages = int(fh.read().split()[1])
+  except (IOError, OSError, IndexError, ValueError):
+    return None
+  return pages * os.sysconf('SC_PAGE_SIZE')
+
+
+class TestSessionSoak(unittest.TestCase):
+  def setUp(self):
+    self.specs = [syntrax.parse_spec_file(f)
+      for f in sorted(glob.glob(os.path.join(spec_dir, '*.spec')))]
+    self.out_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.out_dir)
+
+  def render_many(self, session, count, start=0):
+    for i in range(start, start + count):
+      spec, url_map = self.specs[i % len(self.specs)]
+      # Vary the title so the text cache keeps seeing new entries
+      out_file = os.path.join(self.out_dir, 'soak{}.svg'.format(i % 10))
+      session.render(spec, 'Render {}'.format(i), url_map, out_file)
+      self.assertTrue(session.canvas is None)
+      self.assertTrue(len(session.text_sizes) <= session.cache_size)
+
+  def test_flat_memory(self):
+    if resident_bytes() is None:
+      raise unittest.SkipTest('/proc/self/statm is not available')
+
+    session = syntrax.RenderSession(syntrax.DrawStyle(), syntrax.MetricsTextBBox(), cache_size=256)
+    with session:
+      self.render_many(session, warmup_renders)
+      gc.collect()
+      start = resident_bytes()
+
+      self.render_many(session, soak_renders, warmup_renders)
+      gc.collect()
+      end = resident_bytes()
+
+    self.assertTrue(end - start < max_growth,
+      'RSS grew by {} bytes over {} renders'.format(end - start, soak_renders))
+    self.assertEqual(len(session.text_sizes), 0)
+
+
+if __name__ == '__main__':
+  unittest.main()
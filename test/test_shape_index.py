@@ -0,0 +1,85 @@
+'''Finding the shapes in part of a diagram'''
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import syntrax
+
+spec_text = u'''
+stack(
+  line('SELECT', opt('DISTINCT'), loop('/expr', ','), 'FROM', '/table'),
+  line(opt('WHERE', '/expr'), opt('GROUP BY', loop('/column', ',')))
+)
+url_map = {'expr': 'expr.html', 'table': 'table.html', 'column': 'column.html'}
+'''
+
+
+class TestShapeIndex(unittest.TestCase):
+  def setUp(self):
+    self.styles = syntrax.DrawStyle()
+    spec, self.url_map = syntrax.parse_spec(spec_text)
+    self.rc, self.bbox = syntrax.layout_railroad(spec, 'Query', self.url_map, self.styles,
+      syntrax.MetricsTextBBox())
+
+  def svg(self, rc, bbox, scale=1.0):
+    drawing = syntrax.draw_canvas(rc, bbox, 'svg', 'svg', self.styles, scale, False)
+    return syntrax.encode_drawing(drawing, 'svg', 'svg').decode('utf-8')
+
+  def test_query_matches_brute_force(self):
+    index = syntrax.ShapeIndex(self.rc, self.bbox, self.styles, cell_size=32)
+    W, H = syntrax.diagram_size(self.bbox, self.styles)
+    m = index.margin
+    r = random.Random(1)
+    for _ in range(200):
+      x0, y0 = r.uniform(-50, W + 50), r.uniform(-50, H + 50)
+      x1, y1 = x0 + r.uniform(0, W / 2), y0 + r.uniform(0, H / 2)
+      expected = [i for i, (bx0, by0, bx1, by1) in enumerate(index.boxes)
+        if bx0 - m <= x1 and x0 <= bx1 + m and by0 - m <= y1 and y0 <= by1 + m]
+      self.assertEqual(index.query(x0, y0, x1, y1), expected)
+
+  def test_crop_size(self):
+    for scale in (1.0, 2.0):
+      for region in [(0, 0, 100, 60), (37, 11, 290, 95)]:
+        crop, bbox = syntrax.crop_canvas(self.rc, self.bbox, self.styles, region, scale)
+        size = (region[2] - region[0], region[3] - region[1])
+        self.assertEqual(syntrax.diagram_size(bbox, self.styles, scale), size)
+        self.assertTrue(len(crop.shapes) < len(self.rc.shapes))
+
+        svg = self.svg(crop, bbox, scale)
+        self.assertTrue('width="{}" height="{}"'.format(*size) in svg)
+
+  def test_image_map_matches_svg(self):
+    index = syntrax.ShapeIndex(self.rc, self.bbox, self.styles)
+    image_map = syntrax.html_image_map(index, 'query')
+    svg = self.svg(self.rc, self.bbox)
+
+    # Outlined boxes in the SVG with the stroke included
+    boxes = set()
+    for rect in re.findall(r'<rect ([^>]*)/>', svg):
+      attrs = dict(re.findall(r'([\w-]+)="([^"]*)"', rect))
+      if 'stroke-width' not in attrs or attrs.get('stroke') == 'none':
+        continue
+      x, y, w, h, sw = [float(attrs[k]) for k in ('x', 'y', 'width', 'height', 'stroke-width')]
+      boxes.add(tuple(int(round(v)) for v in (x - sw/2, y - sw/2, x + w + sw/2, y + h + sw/2)))
+
+    areas = re.findall(r'coords="(\d+),(\d+),(\d+),(\d+)" href="([^"]+)"', image_map)
+    self.assertEqual(sorted(set(a[4] for a in areas)), sorted(self.url_map.values()))
+    for area in areas:
+      self.assertTrue(tuple(int(v) for v in area[:4]) in boxes, area)
+
+  def test_node_at(self):
+    index = syntrax.ShapeIndex(self.rc, self.bbox, self.styles)
+    for box, text, href in index.links():
+      x, y = (box[0] + box[2]) / 2.0, (box[1] + box[3]) / 2.0
+      self.assertEqual(index.node_at(x, y), (text, href))
+    self.assertEqual(index.node_at(-100, -100), None)
+
+
+if __name__ == '__main__':
+  unittest.main()
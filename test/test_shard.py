@@ -0,0 +1,51 @@
+'''Splitting a batch of specs into shards'''
+
+from __future__ import print_function
+
+import os
+import sys
+import random
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import syntrax
+
+
+class TestShardSpecs(unittest.TestCase):
+  def setUp(self):
+    self.spec_dir = tempfile.mkdtemp()
+    r = random.Random(2)
+    self.files = []
+    for i in range(60):
+      fname = os.path.join(self.spec_dir, 'spec{}.spec'.format(i))
+      with open(fname, 'w') as fh:
+        # Some specs have the same size to exercise the tie break
+        fh.write("line('{}')\n".format('x' * r.choice([1, 5, 20, 80, 300, r.randint(1, 2000)])))
+      self.files.append(fname)
+
+  def tearDown(self):
+    shutil.rmtree(self.spec_dir)
+
+  def shards(self, files, count):
+    return [syntrax.shard_specs(files, i, count) for i in range(1, count+1)]
+
+  def test_balanced(self):
+    largest = max(os.path.getsize(f) for f in self.files)
+    for count in (2, 3, 7):
+      shards = self.shards(self.files, count)
+      assigned = sorted(fname for jobs in shards for fname, digest, cost in jobs)
+      self.assertEqual(assigned, sorted(self.files))
+
+      loads = [sum(cost for fname, digest, cost in jobs) for jobs in shards]
+      self.assertTrue(max(loads) - min(loads) <= largest, loads)
+
+  def test_independent_of_order(self):
+    files = list(self.files)
+    random.Random(3).shuffle(files)
+    self.assertEqual(self.shards(files, 4), self.shards(self.files, 4))
+
+
+if __name__ == '__main__':
+  unittest.main()
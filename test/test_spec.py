@@ -0,0 +1,47 @@
+'''Reading spec files without evaluating them'''
+
+from __future__ import print_function, unicode_literals
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import syntrax
+
+
+class TestParseSpec(unittest.TestCase):
+  def test_diagram_functions(self):
+    spec, url_map = syntrax.parse_spec('''
+indentstack(10, line(opt('-'), choice('0', line('1-9', loop(None, '0-9')))),
+  optloop(['a', 'b'], ('c',)), -2)
+url_map = {'a': 'http://example.com'}
+''')
+    self.assertEqual(spec, ['line', 'bullet',
+      ['indentstack', 10, ['line', ['opt', '-'], ['or', '0', ['line', '1-9', ['loop', None, '0-9']]]],
+        ['optloop', ['a', 'b'], [('c',)]], -2], 'bullet'])
+    self.assertEqual(url_map, {'a': 'http://example.com'})
+
+  def test_rejected(self):
+    for text in ("__import__('os').system('true')", "open('spec')", "line('a').__class__",
+        "line(*['a'])", "line(x='a')", "'a' * 1000", "{'a': 1}", "(lambda: 'a')()", "loop('a')",
+        "line(" * 500 + ")" * 500):
+      self.assertRaises(syntrax.SpecError, syntrax.parse_spec, text)
+
+  def test_bad_url_map(self):
+    for text in ("line('a')\nurl_map = {'a': }", "line('a')\nurl_map = {'a': open('x')}",
+        "line('a')\nurl_map = ['a']"):
+      self.assertRaises(syntrax.SpecError, syntrax.parse_spec, text)
+
+  def test_limits(self):
+    text = 'line(' + ', '.join("'x'" for _ in range(100)) + ')'
+    self.assertRaises(syntrax.LimitError, syntrax.parse_spec, text, syntrax.RenderLimits(max_nodes=50))
+    syntrax.parse_spec(text, syntrax.RenderLimits(max_nodes=200))
+
+    text = "line(line(line(line(line('a')))))"
+    self.assertRaises(syntrax.LimitError, syntrax.parse_spec, text, syntrax.RenderLimits(max_depth=4))
+    syntrax.parse_spec(text, syntrax.RenderLimits(max_depth=6))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,77 @@
+'''Rendering diagrams for the Sphinx extension'''
+
+from __future__ import print_function
+
+import os
+import sys
+import gzip
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+try:
+  import syntrax_sphinx
+except ImportError:
+  syntrax_sphinx = None
+
+try:
+  import cairo
+except ImportError:
+  cairo = None
+
+# Bytes at the start of each format
+magic = {
+  'svg': b'<?xml',
+  'svgz': b'\x1f\x8b',
+  'json': b'{',
+  'pdf': b'%PDF',
+  'png': b'\x89PNG'
+}
+
+
+@unittest.skipIf(syntrax_sphinx is None, 'Sphinx is not available')
+class TestRenderJob(unittest.TestCase):
+  def setUp(self):
+    self.out_dir = tempfile.mkdtemp()
+    self.job = {
+      'spec': u"line('a', loop('/b', ','))",
+      'style': None,
+      'title': u'Title',
+      'scale': 1.0,
+      'transparent': False,
+      'metrics': 'builtin'
+    }
+
+  def tearDown(self):
+    shutil.rmtree(self.out_dir)
+
+  def render(self, fmt):
+    out_file = os.path.join(self.out_dir, 'syntrax-key.' + fmt)
+    syntrax_sphinx.render_job(self.job, out_file)
+    self.assertEqual(os.listdir(self.out_dir), [os.path.basename(out_file)])
+    with open(out_file, 'rb') as fh:
+      data = fh.read()
+    self.assertTrue(data.startswith(magic[fmt]), '{} starts with {!r}'.format(fmt, data[:10]))
+    return out_file
+
+  def test_svg_formats(self):
+    for fmt in ('svg', 'svgz', 'json'):
+      out_file = self.render(fmt)
+      os.remove(out_file)
+
+  def test_svgz_contains_svg(self):
+    with gzip.open(self.render('svgz'), 'rb') as fh:
+      self.assertTrue(b'<svg' in fh.read())
+
+  @unittest.skipIf(cairo is None, 'Cairo is not available')
+  def test_cairo_formats(self):
+    self.job['metrics'] = 'pango'
+    for fmt in ('pdf', 'png'):
+      out_file = self.render(fmt)
+      os.remove(out_file)
+
+
+if __name__ == '__main__':
+  unittest.main()
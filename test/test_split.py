@@ -0,0 +1,87 @@
+'''Splitting large diagrams into parts'''
+
+from __future__ import print_function
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import syntrax
+
+max_pixels = 60000
+
+
+def elements(count):
+  items = []
+  for i in range(count):
+    kind = i % 4
+    if kind == 0:
+      items.append('token{}'.format(i))
+    elif kind == 1:
+      items.append(syntrax.opt('x' * (i % 7 + 1)))
+    elif kind == 2:
+      items.append(syntrax.choice('a{}'.format(i), 'bb', 'ccc'))
+    else:
+      items.append(syntrax.loop('item', ','))
+  return items
+
+
+class TestSplitRailroad(unittest.TestCase):
+  def setUp(self):
+    self.styles = syntrax.DrawStyle()
+    self.text_bbox = syntrax.MetricsTextBBox()
+    self.specs = [
+      ['line', 'bullet', syntrax.line(*elements(40)), 'bullet'],
+      ['line', 'bullet', syntrax.stack(*[syntrax.line(e, 'end') for e in elements(20)]), 'bullet']
+    ]
+
+  def area(self, spec):
+    return syntrax.measure_railroad(spec, 'Title (part 1)', {}, self.styles, 1.0, self.text_bbox)
+
+  def run_spec(self, spec, num, first, last):
+    '''Build the spec of a part in the same way as split_railroad()'''
+    head, seq, items, tail = syntrax.split_sequence(spec)
+    start = head if first == 0 else ['/from part {}'.format(num - 1)]
+    end = tail if last == len(items) else ['/to part {}'.format(num + 1)]
+    return ['line'] + start + [seq + items[first:last]] + end
+
+  def test_parts_are_longest_runs(self):
+    for spec in self.specs:
+      parts = syntrax.split_railroad(spec, 'Title', {}, self.styles, max_pixels, 1.0, self.text_bbox)
+      self.assertTrue(len(parts) > 2)
+      head, seq, items, tail = syntrax.split_sequence(spec)
+
+      first = 0
+      for num, (part, title, url_map) in enumerate(parts, 1):
+        last = first + len(part[2]) - len(seq)
+        self.assertEqual(part, self.run_spec(spec, num, first, last))
+        self.assertEqual(title, 'Title (part {})'.format(num))
+
+        W, H = syntrax.measure_railroad(part, title, url_map, self.styles, 1.0, self.text_bbox)
+        self.assertTrue(W * H <= max_pixels or last - first == 1)
+        if last < len(items): # One more element doesn't fit
+          W, H = syntrax.measure_railroad(self.run_spec(spec, num, first, last + 1), title, url_map,
+            self.styles, 1.0, self.text_bbox)
+          self.assertTrue(W * H > max_pixels)
+        first = last
+
+      self.assertEqual(first, len(items))
+
+  def test_line_area_grows_with_run(self):
+    # The split point search finds the longest run that fits when this holds
+    spec = self.specs[0]
+    areas = []
+    for last in range(1, len(syntrax.split_sequence(spec)[2]) + 1):
+      W, H = self.area(self.run_spec(spec, 1, 0, last))
+      areas.append(W * H)
+    self.assertEqual(areas, sorted(areas))
+
+  def test_small_diagram_unchanged(self):
+    spec = ['line', 'bullet', syntrax.line('a', 'b'), 'bullet']
+    self.assertEqual(syntrax.split_railroad(spec, None, {}, self.styles, max_pixels, 1.0, self.text_bbox),
+      [(spec, None, {})])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,78 @@
+'''Render the documentation examples from several threads at once'''
+
+from __future__ import print_function
+
+import os
+import sys
+import glob
+import random
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import syntrax
+
+spec_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'doc', 'images')
+
+thread_count = 8
+rounds = 3
+
+
+def render_bytes(spec, url_map, styles, fmt, text_bbox):
+  backend = syntrax.format_backend(fmt)
+  rc, bbox = syntrax.layout_railroad(spec, 'Title', url_map, styles, text_bbox)
+  drawing = syntrax.draw_canvas(rc, bbox, fmt, backend, styles, 1.0, False)
+  return syntrax.encode_drawing(drawing, fmt, backend)
+
+
+class TestThreads(unittest.TestCase):
+  def setUp(self):
+    self.specs = [(os.path.basename(f),) + syntrax.parse_spec_file(f)
+      for f in sorted(glob.glob(os.path.join(spec_dir, '*.spec')))]
+    self.assertTrue(len(self.specs) > 0)
+    self.styles = syntrax.DrawStyle()
+
+  def check_threads(self, fmt, text_bbox):
+    # Reference output from a serial run
+    expected = dict((name, render_bytes(spec, url_map, self.styles, fmt, text_bbox))
+      for name, spec, url_map in self.specs)
+
+    failures = []
+    errors = []
+
+    def worker(seed):
+      order = list(self.specs)
+      random.Random(seed).shuffle(order)
+      try:
+        for _ in range(rounds):
+          for name, spec, url_map in order:
+            if render_bytes(spec, url_map, self.styles, fmt, text_bbox) != expected[name]:
+              failures.append(name)
+      except Exception as e:
+        errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(thread_count)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+
+    self.assertEqual(errors, [])
+    self.assertEqual(failures, [])
+
+  def test_svg_builtin_metrics(self):
+    self.check_threads('svg', syntrax.MetricsTextBBox())
+
+  def test_json_builtin_metrics(self):
+    self.check_threads('json', syntrax.MetricsTextBBox())
+
+  def test_png_pango(self):
+    try:
+      syntrax.load_backend('cairo')
+    except ImportError:
+      raise unittest.SkipTest('cairo and Pango are not installed')
+    self.check_threads('png', syntrax.cairo_text_bbox)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,52 @@
+'''Rendering requests in worker mode'''
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(test_dir, '..'))
+import syntrax
+
+spec_text = u"line('aaaaaaaa', 'bbbbbbbbb', 'cccccccc', 'dddddddd', 'eeeeeeee', 'ffffffff')"
+
+
+class TestWorker(unittest.TestCase):
+  def setUp(self):
+    self.out_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.out_dir)
+
+  def test_max_width_per_scale(self):
+    scales = [1.0, 2.0, 1.0, 0.5]
+    requests = [{'id': i, 'spec': spec_text, 'scale': scale,
+      'output': os.path.join(self.out_dir, 'd{}.svg'.format(i))} for i, scale in enumerate(scales)]
+
+    cmd = [sys.executable, os.path.join(test_dir, '..', 'syntrax.py'), '--worker', '--metrics', 'builtin',
+      '--max-width', '400', '-s', os.path.join(self.out_dir, 'none.ini')]
+    worker = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = worker.communicate(''.join(json.dumps(r) + '\n' for r in requests).encode('utf-8'))
+    replies = [json.loads(line) for line in out.decode('utf-8').splitlines()]
+    self.assertEqual(len(replies), len(requests), err)
+
+    spec, url_map = syntrax.parse_spec(spec_text)
+    for req, reply in zip(requests, replies):
+      self.assertEqual(reply['status'], 'ok', reply)
+      styles = syntrax.DrawStyle()
+      styles.max_width = 400 / req['scale']
+      size = syntrax.measure_railroad(spec, None, url_map, styles, req['scale'], syntrax.MetricsTextBBox())
+      self.assertEqual((reply['width'], reply['height']), size)
+
+    # Each scale wraps the diagram differently
+    self.assertEqual(len(set(r['height'] / s for r, s in zip(replies, scales))), 3)
+
+
+if __name__ == '__main__':
+  unittest.main()